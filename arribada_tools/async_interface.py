@@ -0,0 +1,185 @@
+import sys
+import threading
+import logging
+import Queue
+import backend
+import fake_tag
+import interface
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResult(threading._Event):
+    """Result of a queued operation which is set once the operation
+    completes, in the style of pyusb.UsbOverlappedResult"""
+    value = None
+    exc_info = None
+
+    def __init__(self):
+        threading._Event.__init__(self)
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def result(self, timeout=None):
+        """Wait for the operation to complete and return its value, or
+        raise the exception it raised"""
+        if not self.wait(timeout):
+            raise interface.ExceptionBackendCommsError('TIMEOUT_ERROR')
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def add_done_callback(self, fn):
+        """Call fn with this result once the operation completes, or
+        straight away if it already has.  Callbacks run on the worker
+        thread so should not block."""
+        with self._lock:
+            if not self.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _complete(self, value=None, exc_info=None):
+        self.value = value
+        self.exc_info = exc_info
+        with self._lock:
+            self.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except:
+                logger.error("Unexpected error in callback: %s", sys.exc_info()[0])
+
+
+class AsyncWorker(threading.Thread):
+    """Runs queued calls one at a time, in order, on its own thread"""
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            (result, fn, args, kwargs) = request
+            try:
+                result._complete(fn(*args, **kwargs))
+            except:
+                result._complete(exc_info=sys.exc_info())
+
+    def submit(self, fn, *args, **kwargs):
+        result = AsyncResult()
+        self._queue.put((result, fn, args, kwargs))
+        return result
+
+    def stop(self):
+        self._queue.put(None)
+        if threading.current_thread() is not self:
+            self.join()
+
+
+def wait_all(results, timeout=None):
+    """Wait for every result in turn and return a list of their values.
+    The first exception raised by an operation is re-raised."""
+    return [i.result(timeout) for i in results]
+
+
+class _AsyncBackend(object):
+    """Non-blocking wrapper of a blocking backend.  The backend is
+    created and every operation run on a dedicated worker thread, so
+    each call returns an AsyncResult straight away and operations on
+    one device complete in the order they were issued.  The connected
+    result completes once the backend has been created."""
+
+    def __init__(self, factory, *args, **kwargs):
+        self.backend = None
+        self._worker = AsyncWorker()
+        self.connected = self._worker.submit(self._connect, factory, args, kwargs)
+
+    def _connect(self, factory, args, kwargs):
+        self.backend = factory(*args, **kwargs)
+        return self.backend
+
+    def _call(self, name, *args):
+        if self.backend is None:
+            raise backend.ExceptionBackendNotFound
+        return getattr(self.backend, name)(*args)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn to run on this backend's worker thread"""
+        return self._worker.submit(fn, *args, **kwargs)
+
+    def command_response(self, command, timeout=None):
+        return self.submit(self._call, 'command_response', command, timeout)
+
+    def write(self, data, timeout=None):
+        return self.submit(self._call, 'write', data, timeout)
+
+    def read(self, length, timeout=None):
+        return self.submit(self._call, 'read', length, timeout)
+
+    def read_to_file(self, length, fp, timeout=None):
+        return self.submit(self._call, 'read_to_file', length, fp, timeout)
+
+    def cleanup(self):
+        """Clean up the backend and stop the worker thread once all
+        queued operations have completed"""
+        result = self.submit(lambda: self.backend.cleanup() if self.backend else None)
+        self._worker.stop()
+        return result
+
+
+class AsyncBackendUsb(_AsyncBackend):
+
+    def __init__(self, *kwargs):
+        _AsyncBackend.__init__(self, backend.BackendUsb)
+
+
+class AsyncBackendBluetooth(_AsyncBackend):
+
+    def __init__(self, dev_addr=None, conn_timeout=None, hci_dev=None):
+        _AsyncBackend.__init__(self, backend.BackendBluetooth, dev_addr, conn_timeout, hci_dev)
+
+
+class AsyncBackendFakeTag(_AsyncBackend):
+
+    def __init__(self, tag=None):
+        _AsyncBackend.__init__(self, fake_tag.BackendFakeTag, tag)
+
+
+class AsyncConfigInterface(object):
+    """Non-blocking mirror of ConfigInterface.  Every public
+    ConfigInterface method is available under the same name and with
+    the same arguments, but returns an AsyncResult straight away.  The
+    calls run in order on the backend's worker thread, so a single
+    thread can drive many tags at once e.g.,
+
+        cfgs = [AsyncConfigInterface(AsyncBackendBluetooth(i)) for i in addrs]
+        statuses = wait_all([i.get_status() for i in cfgs])
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._cfg = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(interface.ConfigInterface, name, None)):
+            raise AttributeError(name)
+        def method(*args, **kwargs):
+            return self._backend.submit(self._call, name, args, kwargs)
+        method.__name__ = name
+        return method
+
+    def _call(self, name, args, kwargs):
+        if self._cfg is None:
+            if self._backend.backend is None:
+                raise backend.ExceptionBackendNotFound
+            self._cfg = interface.ConfigInterface(self._backend.backend)
+        return getattr(self._cfg, name)(*args, **kwargs)
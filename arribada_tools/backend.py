@@ -1,6 +1,7 @@
 import pyusb
 import message
 from array import array
+from collections import deque
 try: # BLE is currently not supported on Windows
     from ble import BluetoothTracker
 except:
@@ -29,15 +30,22 @@ class _Backend(object):
     def read(self, length, timeout=None):
         pass
 
+    def read_to_file(self, length, fp, timeout=None):
+        """Read data and write it to the file object fp.  Returns the
+        number of bytes written."""
+        data = self.read(length, timeout)
+        fp.write(data)
+        return len(data)
+
     def cleanup(self):
         pass
 
 
 class BackendBluetooth(_Backend):
 
-    def __init__(self, dev_addr=None, conn_timeout=None):
+    def __init__(self, dev_addr=None, conn_timeout=None, hci_dev=None):
         try:
-            self._ble = BluetoothTracker(dev_addr, conn_timeout=conn_timeout)
+            self._ble = BluetoothTracker(dev_addr, conn_timeout=conn_timeout, hci_dev=hci_dev)
         except:
             raise ExceptionBackendNotFound
 
@@ -62,7 +70,12 @@ class BackendBluetooth(_Backend):
             return msg
 
     def write(self, data, timeout=None):
-        self._ble.write(data)
+        """Write bulk data in packets sized to the negotiated ATT MTU.
+        Packets are written without response, with flow control from
+        a response every ble.FLOW_CONTROL_INTERVAL packets and for the
+        last packet.  Returns the number of bytes written.
+        """
+        self._ble.write(data, bulk=True)
         return len(data)
 
     def read(self, length, timeout=None):
@@ -74,6 +87,11 @@ class BackendBluetooth(_Backend):
 
 class BackendUsb(_Backend):
 
+    # Maximum size of a single bulk IN transfer used by read()
+    transfer_size = 65536
+    # Number of bulk IN transfers read() keeps queued at once
+    transfers_in_flight = 3
+
     def __init__(self, *kwargs):
         try:
             self._usb = pyusb.UsbHost()
@@ -137,25 +155,57 @@ class BackendUsb(_Backend):
         return size
 
     def read(self, length, timeout=None):
-        """Read data transparently over USB in small chunks
-        until all bytes are received or a timeout occurs.  Returns
-        the data buffer received.
+        """Read data transparently over USB using large bulk transfers
+        into a single preallocated buffer until all bytes are received
+        or a timeout occurs.  Returns the bytearray received.
         """
 
         if timeout != None:
             timeout = timeout * 1000 # Scale timeout to milliseconds
             timeout = int(timeout)
 
-        data = array('B', [])
-        while length > 0:
-            resp = self._usb.read(pyusb.EP_MSG_IN, min(512, length), timeout)
+        data = bytearray(length)
+        offset = 0
+        requested = 0
+        pending = deque()
+        while offset < length:
+            # Keep several transfers queued so the endpoint never idles
+            # waiting for us to collect the previous buffer
+            while requested < length and len(pending) < self.transfers_in_flight:
+                size = min(self.transfer_size, length - requested)
+                pending.append((self._usb.read(pyusb.EP_MSG_IN, size, timeout), size))
+                requested = requested + size
+            (resp, size) = pending.popleft()
             resp.wait()
             if resp.status == -1:
                 break
-            if len(resp.buffer):
-                data = data + resp.buffer
-            length = length - len(resp.buffer)
+            data[offset:offset + resp.status] = resp.buffer
+            offset = offset + resp.status
+            requested = requested - (size - resp.status) # Re-request any shortfall
+
+        # Abandon transfers still queued so they do not consume later data
+        for (resp, _) in pending:
+            resp.cancel = True
+        for (resp, _) in pending:
+            resp.wait()
+
+        if offset < length:
+            del data[offset:] # Truncate in place on a short read
         return data
 
+    def read_to_file(self, length, fp, timeout=None):
+        """Read data over USB using large transfers and write it
+        straight to the file object fp, until all bytes are received or
+        a timeout occurs.  Returns the number of bytes written.
+        """
+
+        if timeout != None:
+            timeout = timeout * 1000 # Scale timeout to milliseconds
+            timeout = int(timeout)
+
+        resp = self._usb.read_to_file(pyusb.EP_MSG_IN, length, fp, timeout)
+        resp.wait()
+        return resp.status
+
     def cleanup(self):
         self._usb.cleanup()
@@ -3,33 +3,64 @@ import binascii
 import struct
 import os
 import logging
+import threading
+from collections import deque
 import bluepy.btle
 
 
 config_service_uuid = bluepy.btle.UUID('04831523-6c9d-6ca9-5d41-03ad4fff4abb')
 config_char_uuid = bluepy.btle.UUID('04831524-6c9d-6ca9-5d41-03ad4fff4abb')
-MAX_PACKET_SIZE = 20
+MAX_PACKET_SIZE = 20 # Write payload at the default ATT MTU of 23 bytes
+ATT_MTU = 247 # Largest ATT MTU requested on connection
+ATT_WRITE_OVERHEAD = 3 # ATT opcode and handle sent with each write
+FLOW_CONTROL_INTERVAL = 16 # Bulk writes ask for a response every this many packets
 CONNECTION_TIMEOUT = 3
 
-HCI_DEV = 0 if 'HCI_DEV' not in os.environ else int(os.environ['HCI_DEV'])
+# HCI_DEV may list several adapters e.g., HCI_DEV=0,1,2 and the first
+# is used by default
+HCI_DEVS = [int(i) for i in os.environ.get('HCI_DEV', '0').split(',')]
+HCI_DEV = HCI_DEVS[0]
 
 logger = logging.getLogger(__name__)
 
 
 class Buffer():
+    """FIFO of received notification data.  Each notification is queued
+    as is and only copied once, when it is read out."""
     def __init__(self):
-        self._buffer = b''
+        self._chunks = deque()
+        self._offset = 0 # Bytes already read from the first chunk
+        self._occupancy = 0
 
     def write(self, data):
-        self._buffer = self._buffer + data
+        if data:
+            self._chunks.append(data)
+            self._occupancy = self._occupancy + len(data)
+
+    def readinto(self, buf, offset=0):
+        """Move as much data as is available and fits into the bytearray
+        buf, starting at offset.  Returns the number of bytes moved."""
+        end = offset + min(len(buf) - offset, self._occupancy)
+        pos = offset
+        while pos < end:
+            chunk = self._chunks[0]
+            length = min(len(chunk) - self._offset, end - pos)
+            buf[pos:pos + length] = buffer(chunk, self._offset, length)
+            pos = pos + length
+            self._offset = self._offset + length
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        self._occupancy = self._occupancy - (end - offset)
+        return end - offset
 
     def read(self, length):
-        data = self._buffer[:length]
-        self._buffer = self._buffer[length:]
-        return data
-    
+        data = bytearray(min(length, self._occupancy))
+        self.readinto(data)
+        return str(data)
+
     def occupancy(self):
-        return len(self._buffer)
+        return self._occupancy
 
 
 class MyDelegate(bluepy.btle.DefaultDelegate):
@@ -39,7 +70,8 @@ class MyDelegate(bluepy.btle.DefaultDelegate):
         self._buffer = buf
 
     def handleNotification(self, cHandle, data):
-        logger.debug("Received: %s", binascii.hexlify(array('B', data)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received: %s", binascii.hexlify(array('B', data)))
         self._buffer.write(data)
 
 
@@ -51,6 +83,19 @@ def notifications_enable(p, char):
             break
 
 
+def mtu_negotiate(p, mtu):
+    """Request a larger ATT MTU and return the resulting payload size of
+    a single write.  The default packet size is kept unless the helper
+    reports the MTU agreed with the peripheral."""
+    try:
+        rsp = p.setMTU(mtu)
+        negotiated = int(rsp['mtu'][0])
+    except:
+        logger.debug('ATT MTU negotiation failed - using %u byte packets', MAX_PACKET_SIZE)
+        return MAX_PACKET_SIZE
+    return max(MAX_PACKET_SIZE, min(mtu, negotiated) - ATT_WRITE_OVERHEAD)
+
+
 class MyPeripheral(bluepy.btle.Peripheral):
     """
     Override default Peripheral class to add connection timeouts.  By
@@ -82,21 +127,58 @@ class MyPeripheral(bluepy.btle.Peripheral):
                                 "Failed to connect to peripheral %s, addr type: %s" % (addr, addrType))
 
 
+class AdapterPool(object):
+    """A pool of HCI adapters which hands out the least loaded adapter
+    for each new connection"""
+
+    def __init__(self, adapters=None):
+        adapters = adapters if adapters else HCI_DEVS
+        self._connections = dict((i, 0) for i in adapters)
+        self._order = list(adapters)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def acquire(self):
+        """Returns the adapter with fewest connections, which must be
+        given back to release once the connection is closed"""
+        with self._lock:
+            hci_dev = min(self._order, key=lambda i: self._connections[i])
+            self._connections[hci_dev] = self._connections[hci_dev] + 1
+            return hci_dev
+
+    def release(self, hci_dev):
+        with self._lock:
+            self._connections[hci_dev] = self._connections[hci_dev] - 1
+
+
 class BluetoothTracker():
-    def __init__(self, uuid, conn_timeout):
+    def __init__(self, uuid, conn_timeout, hci_dev=None, mtu=ATT_MTU):
         self._buffer = Buffer()
-        self._periph = MyPeripheral(uuid, 'random', HCI_DEV, conn_timeout=conn_timeout)
+        hci_dev = HCI_DEV if hci_dev is None else hci_dev
+        self._periph = MyPeripheral(uuid, 'random', hci_dev, conn_timeout=conn_timeout)
         self._periph.setDelegate(MyDelegate(self._buffer))
         self._config_service = self._periph.getServiceByUUID(config_service_uuid)
         self._config_char = self._config_service.getCharacteristics(config_char_uuid)[0]
         notifications_enable(self._periph, self._config_char)
-
-    def write(self, data):
-        while data: # Send data in discrete packets
-            bytesToSend = min(len(data), MAX_PACKET_SIZE)
-            self._config_char.write(data[:bytesToSend])
-            logger.debug("Transmit: %s", binascii.hexlify(array('B', data[:bytesToSend])))
-            data = data[bytesToSend:]
+        self._packet_size = mtu_negotiate(self._periph, mtu)
+        logger.debug('Using %u byte packets', self._packet_size)
+
+    def write(self, data, bulk=False):
+        # Packets are written without response, bluepy's default.  For
+        # flow control, every FLOW_CONTROL_INTERVAL packets and the last
+        # packet of bulk data are written with response, waiting for the
+        # tag so that its receive buffer cannot overflow
+        packets = 0
+        for pos in range(0, len(data), self._packet_size): # Send data in discrete packets
+            packet = data[pos:pos + self._packet_size]
+            packets = packets + 1
+            with_response = bulk and (packets % FLOW_CONTROL_INTERVAL == 0 or
+                                      pos + self._packet_size >= len(data))
+            self._config_char.write(packet, withResponse=with_response)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Transmit: %s", binascii.hexlify(array('B', packet)))
 
     def read(self, timeout=0):
         # Read just one packet
@@ -105,10 +187,14 @@ class BluetoothTracker():
         return self._buffer.read(self._buffer.occupancy())
 
     def readFull(self, length, timeout=0):
-        # Read up until length has been reached
-        while self._buffer.occupancy() < length:
+        # Read up until length has been reached, moving data into the
+        # output buffer as each notification arrives
+        data = bytearray(length)
+        pos = self._buffer.readinto(data)
+        while pos < length:
             self._periph.waitForNotifications(timeout)
-        return self._buffer.read(length)
+            pos = pos + self._buffer.readinto(data, pos)
+        return data
 
     def cleanup(self):
         self._periph.disconnect()
@@ -0,0 +1,189 @@
+import binascii
+import logging
+import time
+import threading
+from array import array
+import backend
+import config
+import message
+
+
+logger = logging.getLogger(__name__)
+
+
+# Error codes, as indexed by message.str_error
+_CMD_NO_ERROR = 0
+_CMD_ERROR_FILE_NOT_FOUND = 1
+_CMD_ERROR_CONFIG_TAG_NOT_SET = 7
+_CMD_ERROR_INVALID_PARAMETER = 10
+_CMD_ERROR_IMAGE_CRC_MISMATCH = 12
+
+
+class FakeTag(object):
+    """In-memory model of a tag's state: its configuration, log file,
+    flash contents and firmware images.  The state outlives any one
+    connection, so a tag can be reconnected to after a reset.  Every
+    command is delayed by latency seconds to mimic the round trip to a
+    real tag."""
+
+    def __init__(self, unique_device_identifier='0123456789abcdef', log_data=b'',
+                 flash_data=b'', fw_version=1, latency=0.0):
+        self.unique_device_identifier = unique_device_identifier
+        self.fw_version = fw_version
+        self.log_data = bytearray(log_data)
+        self.flash_data = bytearray(flash_data)
+        self.latency = latency
+        self.config = {}
+        self.images = {}
+        self.applied_images = []
+        self.resets = []
+        self.lock = threading.Lock()
+
+
+class BackendFakeTag(backend._Backend):
+    """Backend connected to a FakeTag.  Commands are packed and decoded
+    exactly as they would be on the wire and handled by the tag model,
+    so ConfigInterface can be exercised without hardware."""
+
+    def __init__(self, tag=None):
+        self.tag = tag if tag else FakeTag()
+        self._rx = bytearray()
+        self._write = None
+
+    def command_response(self, command, timeout=None):
+        if self.tag.latency:
+            time.sleep(self.tag.latency)
+        if command is None:
+            # Confirmation of a completed bulk write
+            if self._write is None or len(self._write[1]) < self._write[0]:
+                return None
+            (_, data, handler) = self._write
+            self._write = None
+            with self.tag.lock:
+                resp = handler(bytes(data))
+        else:
+            (msg, _) = message.decode(array('B', command.pack()))
+            handler = getattr(self, '_' + msg.name.lower(), None)
+            if handler is None:
+                logger.debug('Fake tag ignoring %s', msg.name)
+                return None
+            with self.tag.lock:
+                resp = handler(msg)
+        (msg, _) = message.decode(array('B', resp.pack()))
+        return msg
+
+    def write(self, data, timeout=None):
+        if self._write is None:
+            return 0
+        (length, buf, _) = self._write
+        data = data[:length - len(buf)]
+        buf.extend(data)
+        return len(data)
+
+    def read(self, length, timeout=None):
+        data = self._rx[:length]
+        del self._rx[:length]
+        return data
+
+    def _generic(self, error_code=_CMD_NO_ERROR):
+        return message.GenericResponse(error_code=error_code)
+
+    def _expect_write(self, length, handler):
+        self._write = (length, bytearray(), handler)
+
+    def _cfg_erase_req(self, msg):
+        if msg.cfg_tag == 0xFFFF:
+            self.tag.config.clear()
+        else:
+            self.tag.config.pop(msg.cfg_tag, None)
+        return self._generic()
+
+    def _cfg_save_req(self, msg):
+        return self._generic()
+
+    def _cfg_write_req(self, msg):
+        def handler(data):
+            for cfg in config.decode_all(data):
+                self.tag.config[cfg.tag] = cfg
+            return message.ConfigMessage_CFG_WRITE_CNF(error_code=_CMD_NO_ERROR)
+        self._expect_write(msg.length, handler)
+        return self._generic()
+
+    def _cfg_read_req(self, msg):
+        items = dict(self.tag.config)
+        items[config.ConfigItem_Logging_FileSize.tag] = \
+            config.ConfigItem_Logging_FileSize(fileSize=len(self.tag.log_data))
+        if msg.cfg_tag == 0xFFFF:
+            data = config.encode_all([items[i] for i in sorted(items)])
+        elif msg.cfg_tag in items:
+            data = items[msg.cfg_tag].pack()
+        else:
+            return message.ConfigMessage_CFG_READ_RESP(error_code=_CMD_ERROR_CONFIG_TAG_NOT_SET, length=0)
+        self._rx = bytearray(data)
+        return message.ConfigMessage_CFG_READ_RESP(error_code=_CMD_NO_ERROR, length=len(data))
+
+    def _log_create_req(self, msg):
+        self.tag.log_data = bytearray()
+        return self._generic()
+
+    def _log_erase_req(self, msg):
+        self.tag.log_data = bytearray()
+        return self._generic()
+
+    def _log_read_req(self, msg):
+        if msg.start_offset > len(self.tag.log_data):
+            return message.ConfigMessage_LOG_READ_RESP(error_code=_CMD_ERROR_INVALID_PARAMETER, length=0)
+        end = msg.start_offset + msg.length if msg.length else len(self.tag.log_data)
+        self._rx = self.tag.log_data[msg.start_offset:end]
+        return message.ConfigMessage_LOG_READ_RESP(error_code=_CMD_NO_ERROR, length=len(self._rx))
+
+    def _flash_download_req(self, msg):
+        self._rx = bytearray(self.tag.flash_data)
+        return message.ConfigMessage_FLASH_DOWNLOAD_RESP(error_code=_CMD_NO_ERROR, length=len(self._rx))
+
+    def _fw_send_image_req(self, msg):
+        def handler(data):
+            if binascii.crc32(data) & 0xFFFFFFFF != msg.crc:
+                return message.ConfigMessage_FW_SEND_IMAGE_COMPLETE_CNF(error_code=_CMD_ERROR_IMAGE_CRC_MISMATCH)
+            self.tag.images[msg.image_type] = data
+            return message.ConfigMessage_FW_SEND_IMAGE_COMPLETE_CNF(error_code=_CMD_NO_ERROR)
+        self._expect_write(msg.image_length, handler)
+        return self._generic()
+
+    def _fw_apply_image_req(self, msg):
+        if msg.image_type not in self.tag.images:
+            return self._generic(_CMD_ERROR_FILE_NOT_FOUND)
+        self.tag.applied_images.append(msg.image_type)
+        return self._generic()
+
+    def _reset_req(self, msg):
+        if msg.reset_type == 'FLASH':
+            self.tag.config.clear()
+            self.tag.log_data = bytearray()
+        self.tag.resets.append(msg.reset_type)
+        return self._generic()
+
+    def _gps_config_req(self, msg):
+        return self._generic()
+
+    def _cellular_config_req(self, msg):
+        return self._generic()
+
+    def _test_req(self, msg):
+        return self._generic()
+
+    def _battery_status_req(self, msg):
+        return message.ConfigMessage_BATTERY_STATUS_RESP(error_code=_CMD_NO_ERROR, charging_ind=False,
+                                                         charging_level=100, millivolts=4100)
+
+    def _status_req(self, msg):
+        return message.ConfigMessage_STATUS_RESP(error_code=_CMD_NO_ERROR,
+                                                 fw_version=self.tag.fw_version,
+                                                 reserved=0,
+                                                 cfg_version=config.__version__,
+                                                 unique_device_identifier=self.tag.unique_device_identifier,
+                                                 gps_module_detected=True,
+                                                 cellular_module_detected=False,
+                                                 sim_card_present=False,
+                                                 sim_card_imsi=b'',
+                                                 satellite_module_detected=False)
@@ -4,12 +4,28 @@ import logging
 import serial
 import time
 import binascii
+import hashlib
+import struct
 from array import *
+from collections import Counter
 
 
 logger = logging.getLogger(__name__)
 
 _timeout = 1.0
+_ack_timeout = 3.0
+_mga_flash_ack_timeout = 5.0
+_mga_flash_max_data = 512 # Largest MGA-FLASH-DATA payload accepted by the receiver
+_cfg_batch_max = 512 # Largest batch of CFG messages written at once, within the receiver's input buffer
+_cfg_retries = 3
+_read_backoff_min = 0.005 # Idle read interval, doubled after every empty read...
+_read_backoff_max = 0.1 # ...up to this limit
+
+BUNDLE_SUFFIX = '.bundle'
+_BUNDLE_MAGIC = b'AGCB'
+_BUNDLE_VERSION = 1
+_bundle_header = struct.Struct(b'<4sB20s20sI') # Magic, version, source SHA-1, content hash, frame count
+_RINV_FLAGS_BINARY = 0x02
 
 
 class ExceptionGPSCommsTimeoutError(Exception):
@@ -74,102 +90,299 @@ class GPSBridgedBackend(object):
         self._backend.cleanup
 
 
+class GPSConfigBundle(object):
+    """Compiled ASCII configuration: the UBX frames of its CFG messages,
+    in order, the (cls, msg_id) acknowledged for each and a SHA-1 hash
+    of the frames' content"""
+
+    def __init__(self, frames, acks=None):
+        self.frames = frames
+        self.acks = acks if acks else [struct.unpack_from('BB', i, 2) for i in frames]
+        self.hash = hashlib.sha1(b''.join(frames)).digest()
+
+
+def compile_ascii_config(text):
+    """Compile ASCII configuration text, as saved by u-center, to a
+    GPSConfigBundle.  Lines which are not CFG messages are skipped."""
+    frames = []
+    for line in text.splitlines():
+        msg = ubx.ubx_build_from_ascii_cfg(line)
+        if msg:
+            frames.append(msg)
+        else:
+            logger.warn('Not CFG: %s', line)
+    return GPSConfigBundle(frames)
+
+
+def load_config_bundle(filename):
+    """Return the GPSConfigBundle of an ASCII configuration file.  The
+    bundle is cached alongside the file, with BUNDLE_SUFFIX appended to
+    the filename, and only compiled again if the file has changed."""
+    with open(filename, 'r') as fp:
+        text = fp.read()
+    source_hash = hashlib.sha1(text).digest()
+
+    try:
+        with open(filename + BUNDLE_SUFFIX, 'rb') as fp:
+            data = fp.read()
+        (magic, version, cached_source_hash, content_hash, count) = _bundle_header.unpack_from(data, 0)
+        if magic == _BUNDLE_MAGIC and version == _BUNDLE_VERSION and cached_source_hash == source_hash:
+            pos = _bundle_header.size
+            ids = struct.unpack_from(b'<%uB' % (2 * count), data, pos)
+            pos += 2 * count
+            body = data[pos:]
+            bundle = GPSConfigBundle([body[start:end] for (start, end) in ubx.ubx_scan(body)],
+                                     zip(ids[0::2], ids[1::2]))
+            if len(bundle.frames) == count and bundle.hash == content_hash:
+                return bundle
+    except (IOError, OSError, struct.error):
+        pass
+
+    bundle = compile_ascii_config(text)
+    try:
+        with open(filename + BUNDLE_SUFFIX, 'wb') as fp:
+            fp.write(_bundle_header.pack(_BUNDLE_MAGIC, _BUNDLE_VERSION, source_hash, bundle.hash,
+                                         len(bundle.frames)))
+            fp.write(b''.join(struct.pack('BB', *i) for i in bundle.acks))
+            fp.write(b''.join(bundle.frames))
+    except (IOError, OSError):
+        logger.warn('Unable to cache GPS configuration bundle for %s', filename)
+    return bundle
+
+
 class GPSConfig(object):
     """GPS configuration wrapper class for u-blox M8N"""
     def __init__(self, gps_backend):
         # See GPSBridgedBackend and GPSSerialBackend
         self._backend = gps_backend
+        self._parser = ubx.UbxStreamParser()
+        self._frames = self._parser.frames()
+        self._readback = {} # ubx.ubx_cfg_key => payload of the receiver's configuration
 
-    def _wait_for_ack(self):
-        data = array('B', [])
-        retries = 300
-        while retries > 0:
-            data = array('B', data) + array('B', self._backend.read())
-            while True:
-                (msg, data) = ubx.ubx_extract(data)
-                if not msg:
-                    time.sleep(0.01)
-                    break
-                idstr = ubx.ubx_to_string(msg)
-                logger.debug('RX: %s', idstr)
-                if idstr == 'ACK-ACK':
-                    return True
-                elif idstr == 'ACK-NAK':
-                    return False
-            retries = retries - 1
-        raise ExceptionGPSCommsTimeoutError
+    def _read_message(self, deadline):
+        """Return the next UBX (cls, msg_id, payload) received, reading
+        more data from the backend as needed until the deadline passes.
+        Reads back off exponentially while nothing is received."""
+        backoff = _read_backoff_min
+        while True:
+            frame = next(self._frames, None)
+            if frame:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('RX: %s', ubx.ubx_id_to_string(frame[0], frame[1]))
+                return frame
+            self._frames = self._parser.frames()
+            now = time.time()
+            if now >= deadline:
+                raise ExceptionGPSCommsTimeoutError
+            data = self._backend.read()
+            if data:
+                self._parser.feed(data)
+                backoff = _read_backoff_min
+            else:
+                time.sleep(min(backoff, deadline - now))
+                backoff = min(backoff * 2, _read_backoff_max)
 
-    def _wait_for_mga_flash_ack(self, expected_sequence):
-        data = array('B', [])
-        retries = 500
-        while retries > 0:
-            data = array('B', data) + array('B', self._backend.read())
-            while True:
-                (msg, data) = ubx.ubx_extract(data)
-                if not msg:
-                    time.sleep(0.01)
-                    break
-                idstr = ubx.ubx_to_string(msg)
-                logger.debug('RX: %s', idstr)
-                if idstr == 'MGA-FLASH':
-                    (ack, sequence) = ubx.ubx_mga_flash_ack_extract(msg)
-                    if expected_sequence != sequence or ack == 2:
-                        logger.error('RX: MGA-FLASH failure: expected=%u actual=%u ack=%u',
-                                     expected_sequence, sequence, ack)
-                        raise ExceptionGPSFlashError
-                    logger.debug('RX: MGA-FLASH: seq=%u ack=%u', sequence, ack)
-                    return ack == 0
-            retries = retries - 1
+    def _wait_for_cfg_acks(self, expected):
+        """Wait for the ACK-ACK or ACK-NAK of each (cls, msg_id) in the
+        expected list.  Acks are matched, in order, to the first expected
+        message with the class and id they acknowledge, so when several
+        messages share an id an ack missing for any of them leaves the
+        last unacknowledged instead.  Returns a dict of
+        expected list index => True (ACK) or False (NAK), which is missing
+        any message not acknowledged in time.  CFG messages received, in
+        response to polls, are cached as readback."""
+        acks = {}
+        deadline = time.time() + _ack_timeout
+        while len(acks) < len(expected):
+            try:
+                (cls, msg_id, payload) = self._read_message(deadline)
+            except ExceptionGPSCommsTimeoutError:
+                break
+            if ((cls, msg_id) == ubx.ACK_ACK or (cls, msg_id) == ubx.ACK_NAK) and len(payload) >= 2:
+                acked = struct.unpack_from('BB', payload)
+                for (i, ident) in enumerate(expected):
+                    if ident == acked and i not in acks:
+                        acks[i] = (cls, msg_id) == ubx.ACK_ACK
+                        break
+                deadline = time.time() + _ack_timeout
+            elif cls == ubx.CFG_CFG[0]:
+                payload = payload.tobytes()
+                self._readback[ubx.ubx_cfg_key(cls, msg_id, payload)] = payload
+        return acks
+
+    def _send_cfg_messages(self, msgs, batch_size=0):
+        """Write CFG messages, batched into writes of up to batch_size
+        bytes, and return a list of True (ACK) or False (NAK) for each.
+        Messages which are not acknowledged are sent again, along with
+        every other message of the batch with the same class and id, as
+        it is not known which of those the acks received belong to."""
+        batch_size = min(batch_size, _cfg_batch_max)
+        results = [None] * len(msgs)
+        for _ in range(_cfg_retries):
+            pending = [i for i in range(len(msgs)) if results[i] is None]
+            while pending:
+                batch = [pending.pop(0)]
+                size = len(msgs[batch[0]])
+                while pending and size + len(msgs[pending[0]]) <= batch_size:
+                    size = size + len(msgs[pending[0]])
+                    batch.append(pending.pop(0))
+                for i in batch:
+                    logger.debug('TX: %s: len=%u: %s', ubx.ubx_to_string(msgs[i]), len(msgs[i]),
+                                 binascii.hexlify(msgs[i]))
+                self._backend.write(b''.join(msgs[i] for i in batch))
+                expected = [struct.unpack_from('BB', msgs[i], 2) for i in batch]
+                acks = self._wait_for_cfg_acks(expected)
+                missing = Counter(expected)
+                missing.subtract(expected[j] for j in acks)
+                for (j, ack) in acks.items():
+                    if not missing[expected[j]]:
+                        results[batch[j]] = ack
+            if None not in results:
+                return results
         raise ExceptionGPSCommsTimeoutError
 
-    def mga_ano_session(self, mga_ano_data):
-        """MGA AssistNowOffline session"""
-        #self._backend.write(ubx.ubx_mga_flash_stop())
-        #self._wait_for_mga_flash_ack(0xFFFF)
-        sequence = 0
+    def _wait_for_mga_flash_ack(self):
+        """Wait for the next MGA-FLASH-ACK and return its (ack, sequence)"""
+        deadline = time.time() + _mga_flash_ack_timeout
         while True:
-            mga_ano = b''
-            for _ in range(5):
-                (m, mga_ano_data) = ubx.ubx_extract(mga_ano_data)
-                if not m:
-                    break
-                mga_ano = mga_ano + m
-            if mga_ano:
-                msg = ubx.ubx_mga_flash_data(sequence, mga_ano)
-                retries = 3
-                while retries > 0:
-                    logger.debug('TX: %s: len=%u: seq=%u', ubx.ubx_to_string(msg), len(msg), sequence)
-                    self._backend.write(msg)
-                    if self._wait_for_mga_flash_ack(sequence):
-                        break
-                    retries = retries - 1
-                if retries == 0:
-                    logger.error('MGA-FLASH failed at sequence=%u', sequence)
-                    raise ExceptionGPSFlashError
-            else:
-                break
-            sequence = sequence + 1
-            logger.debug('%u bytes remaining', len(mga_ano_data))
-        self._backend.write(ubx.ubx_mga_flash_stop())
-        self._wait_for_mga_flash_ack(0xFFFF)
-
-    def ascii_config_session(self, text):
-        """ASCII text configuration session"""
-        for line in text.splitlines():
-            msg = ubx.ubx_build_from_ascii_cfg(line)
-            if msg:
-                logger.debug('TX: %s: len=%u: %s', ubx.ubx_to_string(msg), len(msg), binascii.hexlify(msg))
+            (cls, msg_id, payload) = self._read_message(deadline)
+            if (cls, msg_id) == ubx.MGA_FLASH:
+                (ack, sequence) = ubx.ubx_mga_flash_ack_payload_extract(payload)
+                logger.debug('RX: MGA-FLASH: seq=%u ack=%u', sequence, ack)
+                return (ack, sequence)
+
+    def _mga_flash_packets(self, mga_ano_data, messages_per_packet):
+        """Split MGA-ANO data into MGA-FLASH-DATA packets, each holding up
+        to messages_per_packet whole UBX messages"""
+        mga_ano_data = mga_ano_data.tostring() if type(mga_ano_data) == array else bytes(mga_ano_data)
+        packets = []
+        packet = []
+        size = 0
+        for (start, end) in ubx.ubx_scan(mga_ano_data):
+            if packet and (len(packet) == messages_per_packet or size + end - start > _mga_flash_max_data):
+                packets.append(b''.join(packet))
+                packet = []
+                size = 0
+            packet.append(mga_ano_data[start:end])
+            size = size + end - start
+        if packet:
+            packets.append(b''.join(packet))
+        return packets
+
+    def mga_ano_session(self, mga_ano_data, window=1, messages_per_packet=5):
+        """MGA AssistNowOffline session.  Up to window MGA-FLASH-DATA
+        packets are sent ahead of their acknowledgements.  Acks are
+        matched by sequence number and only packets which are NAKed are
+        sent again.  Packets hold up to messages_per_packet MGA-ANO
+        messages, limited by the receiver's maximum MGA-FLASH data size."""
+        packets = self._mga_flash_packets(mga_ano_data, messages_per_packet)
+        logger.debug('Sending %u MGA-FLASH packets', len(packets))
+        in_flight = {} # Sequence number => retries remaining
+        sequence = 0
+        while sequence < len(packets) or in_flight:
+            while sequence < len(packets) and len(in_flight) < window:
+                msg = ubx.ubx_mga_flash_data(sequence, packets[sequence])
+                logger.debug('TX: %s: len=%u: seq=%u', ubx.ubx_to_string(msg), len(msg), sequence)
                 self._backend.write(msg)
-                if not self._wait_for_ack():
-                    logger.warn('NAK: %s', line)
-                else:
-                    logger.debug('ACK: %s', line)
+                in_flight[sequence] = 3
+                sequence = sequence + 1
+            (ack, acked) = self._wait_for_mga_flash_ack()
+            if acked not in in_flight or ack == 2:
+                logger.error('RX: MGA-FLASH failure: sequence=%u ack=%u', acked, ack)
+                raise ExceptionGPSFlashError
+            if ack == 0:
+                del in_flight[acked]
+                continue
+            in_flight[acked] = in_flight[acked] - 1
+            if in_flight[acked] == 0:
+                logger.error('MGA-FLASH failed at sequence=%u', acked)
+                raise ExceptionGPSFlashError
+            msg = ubx.ubx_mga_flash_data(acked, packets[acked])
+            logger.debug('TX: %s: len=%u: seq=%u (retry)', ubx.ubx_to_string(msg), len(msg), acked)
+            self._backend.write(msg)
+        self._backend.write(ubx.ubx_mga_flash_stop())
+        (ack, acked) = self._wait_for_mga_flash_ack()
+        if acked != 0xFFFF or ack == 2:
+            logger.error('RX: MGA-FLASH failure: expected=%u actual=%u ack=%u', 0xFFFF, acked, ack)
+            raise ExceptionGPSFlashError
+
+    def ascii_config_session(self, text, batch_size=0, skip_matching=False):
+        """ASCII text configuration session, see config_bundle_session.
+        The configuration is applied even if already recorded as applied,
+        and the receiver's remote inventory is only changed by the text."""
+        self.config_bundle_session(compile_ascii_config(text), batch_size, skip_matching, False)
+
+    def _applied_hash_record(self, bundle):
+        """CFG-RINV message recording the hash of an applied bundle in
+        the receiver's remote inventory"""
+        return ubx.ubx_build(ubx.CFG_RINV[0], ubx.CFG_RINV[1],
+                             struct.pack('B', _RINV_FLAGS_BINARY) + _BUNDLE_MAGIC + bundle.hash)
+
+    def config_bundle_session(self, bundle, batch_size=0, skip_matching=False, skip_applied=True):
+        """Configuration session applying a GPSConfigBundle.  CFG messages
+        are written in batches of up to batch_size bytes, at most
+        _cfg_batch_max, or one at a time by default.  With skip_matching
+        the configuration each message sets is first polled, unless
+        already read back through this GPSConfig, and messages which
+        would not change it are not sent.  With skip_applied a receiver
+        which has already recorded the bundle's hash is not configured at
+        all, and once every message has been acknowledged the hash is
+        recorded in the receiver's CFG-RINV, replacing any remote
+        inventory the bundle sets.  The configuration is only saved to
+        flash if changed.  Returns True if the configuration was
+        written."""
+        if skip_applied:
+            self._send_cfg_messages([ubx.ubx_build(ubx.CFG_RINV[0], ubx.CFG_RINV[1], b'')])
+            inventory = self._readback.get(ubx.ubx_cfg_key(ubx.CFG_RINV[0], ubx.CFG_RINV[1], b''), b'')
+            if inventory[1:].startswith(_BUNDLE_MAGIC + bundle.hash):
+                logger.debug('Configuration %s already applied', binascii.hexlify(bundle.hash))
+                return False
+
+        msgs = []
+        for (msg, ack) in zip(bundle.frames, bundle.acks):
+            payload = msg[6:-2]
+            msgs.append((msg, ubx.ubx_cfg_key(ack[0], ack[1], payload), payload))
+
+        if skip_matching:
+            polls = []
+            for (_, key, _) in msgs:
+                poll = ubx.ubx_build(*key)
+                if key not in self._readback and poll not in polls:
+                    polls.append(poll)
+            self._send_cfg_messages(polls, batch_size)
+            unchanged = [i for i in msgs if self._readback.get(i[1]) == i[2]]
+            for i in unchanged:
+                logger.debug('Unchanged: %s: %s', ubx.ubx_to_string(i[0]), binascii.hexlify(i[0]))
+            msgs = [i for i in msgs if i not in unchanged]
+
+        acks = self._send_cfg_messages([i[0] for i in msgs], batch_size) if msgs else []
+        changed = bool(msgs)
+        for ((msg, key, payload), ack) in zip(msgs, acks):
+            if not ack:
+                logger.warn('NAK: %s: %s', ubx.ubx_to_string(msg), binascii.hexlify(msg))
+                self._readback.pop(key, None)
             else:
-                logger.warn('Not CFG: %s', line)
+                self._readback[key] = payload
+
+        # Only record the configuration as applied once all of it has been,
+        # else a receiver which NAKed part of it would be skipped from now on
+        if skip_applied and False in acks:
+            logger.warn('Configuration %s not recorded as applied', binascii.hexlify(bundle.hash))
+        elif skip_applied:
+            record = self._applied_hash_record(bundle)
+            payload = record[6:-2]
+            key = ubx.ubx_cfg_key(ubx.CFG_RINV[0], ubx.CFG_RINV[1], payload)
+            if self._readback.get(key) != payload:
+                if self._send_cfg_messages([record])[0]:
+                    self._readback[key] = payload
+                else:
+                    logger.warn('NAK: %s: %s', ubx.ubx_to_string(record), binascii.hexlify(record))
+                changed = True
+
+        if not changed:
+            return False
 
         # Save configuration to flash
-        msg = ubx.ubx_cfg_save_flash()
-        logger.debug('TX: %s: len=%u: %s', ubx.ubx_to_string(msg), len(msg), binascii.hexlify(msg))
-        self._backend.write(msg)
-        if not self._wait_for_ack():
+        if not self._send_cfg_messages([ubx.ubx_cfg_save_flash()])[0]:
             raise ExceptionGPSFlashError
+        return True
@@ -2,6 +2,9 @@ import config
 import message
 import logging
 import binascii
+import json
+import time
+import os
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +33,7 @@ def resp_error_handler(req, resp, expected_resp=None):
 class ConfigInterface(object):
 
     timeout = 2.0
+    log_chunk_size = 65536
 
     def __init__(self, backend):
         self._backend = backend
@@ -106,12 +110,70 @@ class ConfigInterface(object):
         resp = self._backend.command_response(cmd, 30 + self.timeout)
         resp_error_handler(cmd.name, resp, 'GENERIC_RESP')
 
-    def read_log_file(self, start_offset=0, length=0):
+    def _read_to_file(self, length, fp):
+        received = self._backend.read_to_file(length, fp, self.timeout)
+        if received != length:
+            logger.error('Failed to receive expected bytes (%u/%u)', received, length)
+            raise ExceptionBackendCommsError('TIMEOUT_ERROR')
+        return received
+
+    def read_log_file(self, start_offset=0, length=0, fp=None):
+        """Read the log file.  The data is returned unless a file object
+        fp is given, in which case the data is streamed straight to it and
+        the number of bytes written is returned."""
         cmd = message.ConfigMessage_LOG_READ_REQ(start_offset=start_offset, length=length)
         resp = self._backend.command_response(cmd, self.timeout)
         resp_error_handler(cmd.name, resp, 'LOG_READ_RESP')
+        if fp:
+            return self._read_to_file(resp.length, fp)
         return self._backend.read(resp.length, self.timeout)
 
+    def download_log_file(self, fp, start_offset=0, length=None, progress=None):
+        """Download the log file in chunks of log_chunk_size bytes,
+        writing each chunk to the file object fp as it arrives so that
+        an interrupted download can be resumed from the last chunk.  The
+        length defaults to the rest of the log file.  If given, progress
+        is called after each chunk with the log file offset reached, the
+        end offset and the throughput in bytes per second.
+        """
+        if length is None:
+            length = self.get_log_file_size() - start_offset
+        end = start_offset + length
+        offset = start_offset
+        start_time = time.time()
+        while offset < end:
+            size = min(self.log_chunk_size, end - offset)
+            if self.read_log_file(offset, size, fp) != size:
+                logger.error('Failed to receive expected log file bytes at offset %u', offset)
+                raise ExceptionBackendCommsError('TIMEOUT_ERROR')
+            fp.flush()
+            offset = offset + size
+            if progress:
+                progress(offset, end, (offset - start_offset) / max(time.time() - start_time, 1E-6))
+        return length
+
+    def download_log_file_resume(self, filename, progress=None):
+        """Download the whole log file to filename.  Data is written to
+        a partial file first which is renamed to filename once the
+        download completes.  If a partial file is left over from an
+        interrupted download then the download resumes from its end.
+        """
+        partial = filename + '.part'
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        total = self.get_log_file_size()
+        if offset > total:
+            logger.warn('Partial log file %s is larger than the log file - restarting download', partial)
+            offset = 0
+        elif offset:
+            logger.info('Resuming log file download at offset %u/%u', offset, total)
+        with open(partial, 'ab' if offset else 'wb') as fp:
+            self.download_log_file(fp, offset, total - offset, progress)
+        os.rename(partial, filename)
+
+    def get_log_file_size(self):
+        resp = json.loads(self.read_json_configuration(tag=config.ConfigItem_Logging_FileSize.tag))
+        return resp['logging']['fileSize']
+
     def fw_upgrade(self, image_type, data):
         crc = binascii.crc32(data) & 0xFFFFFFFF # Ensure CRC32 is unsigned
         cmd = message.ConfigMessage_FW_SEND_IMAGE_REQ(image_type=image_type,
@@ -158,9 +220,14 @@ class ConfigInterface(object):
         resp = self._backend.command_response(cmd, self.timeout)
         resp_error_handler(cmd.name, resp, 'GENERIC_RESP')
 
-    def read_flash_file(self):
+    def read_flash_file(self, fp=None):
+        """Read the flash contents.  The data is returned unless a file
+        object fp is given, in which case the data is streamed straight
+        to it and the number of bytes written is returned."""
         cmd = message.ConfigMessage_FLASH_DOWNLOAD_REQ()
         resp = self._backend.command_response(cmd, self.timeout)
         resp_error_handler(cmd.name, resp, 'FLASH_DOWNLOAD_RESP')
-        logger.debug('Downloading flash file of size: ', resp.length)
+        logger.debug('Downloading flash file of size: %u', resp.length)
+        if fp:
+            return self._read_to_file(resp.length, fp)
         return self._backend.read(resp.length, self.timeout)
@@ -2,6 +2,18 @@ import struct
 import logging
 import sys
 import inspect
+import mmap
+import os
+import multiprocessing
+import bisect
+import heapq
+import calendar
+import re
+from array import array
+try: # numpy is only required for decode_columns
+    import numpy
+except ImportError:
+    numpy = None
 
 
 logger = logging.getLogger(__name__)
@@ -12,50 +24,635 @@ class ExceptionLogInvalidValue(Exception):
 
 
 def decode(data, offset):
-    """Attempt to decode a single log item from an input data buffer.
-    A tuple is returned containing an instance of the log object plus
-    the input data buffer, less the amount of data consumed."""
-    item = TaggedItem()
+    """Attempt to decode a single log item from an input data buffer
+    at the given offset.  The decoded log object is returned or None
+    if the item could not be decoded.  The input may be any object
+    supporting the buffer interface e.g., str, bytearray, memoryview
+    or mmap, and is unpacked in place without copying."""
+    if (offset + _tag_struct.size) > len(data):
+        return None
 
-    if ((len(data) + offset) < item.header_length):
+    # Unpack header tag at current position and find the correct log
+    # class using the tag lookup table
+    (tag,) = _tag_struct.unpack_from(data, offset)
+    entry = _tag_lookup.get(tag)
+    if entry is None:
         return None
 
-    # Unpack header tag at current position
-    item.unpack(data[offset:offset + item.header_length])
-    # Find the correct configuration class based on the configuration tag
-    cfg = None
-    for i in inspect.getmembers(sys.modules[__name__], inspect.isclass):
-        cls = i[1]
-        if issubclass(cls, LogItem) and cls != LogItem and \
-            item.tag == cls.tag:
-            cfg = cls()
-            break
-    if (cfg):
-        try:
-            cfg.unpack(data[offset:offset + cfg.length])
-        except:
-            return None # Likely insufficient bytes to unpack
+    (cls, length) = entry
+    if (offset + length) > len(data):
+        return None # Insufficient bytes to unpack
+
+    cfg = cls()
+    cfg.unpack(data, offset)
 
     return cfg
 
-def decode_all(data):
+def decode_all(data, skipped=None):
     """Iteratively decode an input data buffer to a list of log
-    objects.
+    objects.  If a skipped list is given then decoding recovers from
+    corrupt data instead of stopping, see iter_decode_recover.
+    """
+    if skipped is not None:
+        return list(iter_decode_recover(data, skipped))
+    return list(iter_decode(data))
+
+
+def _corruption_detected(offset):
+    sys.stderr.write('Log file corruption detected at byte ' + str(offset) + '\n')
+
+
+def iter_decode(source, chunk_size=65536):
+    """Generator which decodes log objects, in order, from either an
+    input data buffer or a file object.  File objects are read in
+    chunks of chunk_size bytes and any partial log item at the end of
+    a chunk is carried over to the next one, so memory use does not
+    depend on the size of the log file.  An mmap is decoded in place
+    as a data buffer, although it also has a read method.
+    """
+    if isinstance(source, mmap.mmap) or not hasattr(source, 'read'):
+        offset = 0
+        while offset < len(source):
+            cfg = decode(source, offset)
+            if not cfg:
+                break
+            yield cfg
+            offset += cfg.length
+        if offset != len(source):
+            _corruption_detected(offset)
+        return
+
+    data = b''
+    offset = 0
+    base = 0 # File position of data[0]
+    while True:
+        chunk = source.read(chunk_size)
+        if chunk:
+            data = data[offset:] + chunk
+            base += offset
+            offset = 0
+        while offset < len(data):
+            cfg = decode(data, offset)
+            if not cfg:
+                break
+            yield cfg
+            offset += cfg.length
+        if not chunk or \
+            (offset < len(data) and _tag_struct.unpack_from(data, offset)[0] not in _tag_lookup):
+            break
+    if offset != len(data):
+        _corruption_detected(base + offset)
+
+
+def _window(data, start, end):
+    """Return a str copy of part of an input data buffer"""
+    window = data[start:end]
+    if isinstance(window, memoryview):
+        return window.tobytes()
+    return bytes(window)
+
+
+def _is_plausible(window, lengths, pos, remaining, confirm):
+    """Check whether a chain of log items starting at pos in the window
+    is made up of known tags with consistent lengths.  The chain is
+    plausible once it covers confirm items, with LogStart/LogEnd
+    markers counting double, or ends exactly at the end of the data."""
+    evidence = 0
+    while evidence < confirm:
+        if pos == remaining:
+            return True
+        length = ord(lengths[pos])
+        if not length or (pos + length) > remaining:
+            return False
+        if window[pos] in _marker_tags:
+            evidence += 1
+        evidence += 1
+        pos += length
+    return True
+
+
+def _resync(data, start, confirm=4, window_size=65536):
+    """Find the first plausible log item boundary at or after start in
+    an input data buffer, returning the length of the buffer if there
+    is none.  Candidate positions are located by a regular expression
+    over the buffer translated to item lengths, so that runs of erased
+    or random bytes are skipped without per-byte python code."""
+    end = len(data)
+    lookahead = confirm * _max_length
+    pos = start
+    while pos < end:
+        limit = min(window_size, end - pos)
+        window = _window(data, pos, min(end, pos + limit + lookahead))
+        lengths = window.translate(_length_table)
+        m = _candidate_re.search(lengths)
+        while m and m.start() < limit:
+            i = m.start()
+            if _is_plausible(window, lengths, i, end - pos, confirm):
+                return pos + i
+            m = _candidate_re.search(lengths, i + 1)
+        # Candidates that run into the end of the data are not matched by
+        # the regular expression, so check the tail byte by byte
+        if pos + limit == end:
+            for i in range(max(0, limit - _max_length), limit):
+                if ord(lengths[i]) and _is_plausible(window, lengths, i, end - pos, confirm):
+                    return pos + i
+        pos += limit
+    return end
+
+
+def _skip_corruption(data, offset, skipped):
+    """Skip corrupt data at offset, recording the skipped byte range,
+    and return the offset at which decoding should resume"""
+    resume = _resync(data, offset + 1)
+    logger.warn('Log file corruption detected at byte %u, skipping %u bytes', offset, resume - offset)
+    skipped.append({'start': offset, 'end': resume})
+    return resume
+
+
+def iter_decode_recover(data, skipped):
+    """Generator which decodes log objects, in order, from an input
+    data buffer and recovers from corrupt data.  When a log item can't
+    be decoded the buffer is searched for the next plausible item
+    boundary and decoding resumes from there.  Each skipped byte range
+    is appended to the skipped list as a dict of start and end offset.
     """
-    objects = []
     offset = 0
-    while offset < len(data):
+    end = len(data)
+    while offset < end:
         cfg = decode(data, offset)
         if cfg:
-            objects += [ cfg ]
+            yield cfg
             offset += cfg.length
         else:
-            break
-    if offset != len(data):
-        sys.stderr.write('Log file corruption detected at byte ' + str(offset) + '\n')
+            offset = _skip_corruption(data, offset, skipped)
+
+
+def iter_decode_mmap(filename, skipped=None):
+    """Generator which decodes log objects from a file by memory
+    mapping it, so that large log or flash dump files are decoded in
+    place without being read into memory.  If a skipped list is given
+    then decoding recovers from corrupt data, see iter_decode_recover.
+    """
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if skipped is not None:
+                objects = iter_decode_recover(mm, skipped)
+            else:
+                objects = iter_decode(mm)
+            for cfg in objects:
+                yield cfg
+        finally:
+            mm.close()
+
+
+def _iter_chains(data, skipped=None, window_size=1048576):
+    """Generator which walks the log item chain of an input data buffer,
+    without decoding any items.  Each item's length depends on its tag
+    so the walk is a Python loop, one iteration per log item, over the
+    buffer translated to item lengths a window of window_size bytes at
+    a time.  For each window a (start, end, window, positions) tuple is
+    yielded, where positions lists the offsets of the log items between
+    start and end relative to start.  Consecutive chains are contiguous
+    unless corrupt data was skipped between them.  Corrupt data ends
+    the walk unless a skipped list is given, in which case it is
+    skipped as per iter_decode_recover."""
+    end = len(data)
+    offset = 0
+    while offset < end:
+        window = _window(data, offset, min(end, offset + window_size + _max_length))
+        lengths = window.translate(_length_table)
+        remaining = end - offset
+        limit = min(window_size, remaining)
+        positions = []
+        append = positions.append
+        i = 0
+        while i < limit:
+            length = ord(lengths[i])
+            if not length or (i + length) > remaining:
+                break
+            append(i)
+            i += length
+        if positions:
+            yield (offset, offset + i, window, positions)
+        if i < limit:
+            if skipped is None:
+                _corruption_detected(offset + i)
+                return
+            offset = _skip_corruption(data, offset + i, skipped)
+        else:
+            offset += i
+
+
+def _iter_offsets(data, skipped=None):
+    """Generator which yields the (offset, tag) of each log item of an
+    input data buffer, see _iter_chains"""
+    for (start, _, window, positions) in _iter_chains(data, skipped):
+        for i in positions:
+            yield (start + i, ord(window[i]))
+
+
+def _segment(data, segment_size, skipped=None):
+    """Walk the log item chain of an input data buffer, see
+    _iter_chains, and split it into a list of (start, end) segments of
+    approximately segment_size bytes which begin and end on log item
+    boundaries.  Skipped corrupt data also ends a segment."""
+    segments = []
+    start = 0
+    pos = 0 # End of the previous chain
+    for (chain_start, chain_end, _, _) in _iter_chains(data, skipped):
+        if chain_start != pos:
+            if start < pos:
+                segments.append((start, pos))
+            start = chain_start
+        pos = chain_end
+        if (pos - start) >= segment_size:
+            segments.append((start, pos))
+            start = pos
+    if start < pos:
+        segments.append((start, pos))
+    return segments
+
+
+def _decode_segment(segment):
+    """Decode one (filename, start, end, converter) segment of a log
+    file to a list of log objects, or of the converter's results for
+    each log object.  Runs in a worker process."""
+    (filename, start, end, converter) = segment
+    objects = []
+    with open(filename, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = start
+            while offset < end:
+                cfg = decode(mm, offset)
+                objects.append(converter(cfg) if converter else cfg)
+                offset += cfg.length
+        finally:
+            mm.close()
     return objects
 
 
+def iter_decode_parallel(filename, workers=None, skipped=None, converter=None, segment_size=4194304):
+    """Generator which decodes log objects from a file using a pool of
+    worker processes.  The file is first split into segments on log
+    item boundaries, each segment is decoded by a worker and the
+    results are yielded in file order.  The number of workers defaults
+    to the number of CPUs.  If a skipped list is given then decoding
+    recovers from corrupt data, see iter_decode_recover.
+
+    Passing decoded objects back from the workers costs roughly as
+    much as decoding them, so where the objects are only needed in
+    some other form e.g., JSON, a converter function can be given.  It
+    is applied to each log object by the workers and its results are
+    yielded instead.  The converter must be picklable i.e., a module
+    level function.
+    """
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            segments = _segment(mm, segment_size, skipped)
+        finally:
+            mm.close()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for objects in pool.imap(_decode_segment, [(filename, start, end, converter) for (start, end) in segments]):
+            for cfg in objects:
+                yield cfg
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def decode_all_parallel(filename, workers=None, skipped=None):
+    """Decode a log file to a list of log objects using a pool of
+    worker processes, see iter_decode_parallel.
+    """
+    return list(iter_decode_parallel(filename, workers, skipped))
+
+
+INDEX_SUFFIX = '.idx'
+_INDEX_MAGIC = b'ALIX'
+_INDEX_VERSION = 2
+_index_header = struct.Struct(b'<4sBQdI')
+_index_tag_header = struct.Struct(b'<BII') # Tag, number of runs, length of encoded runs
+_index_count = struct.Struct(b'<Q')
+_index_checkpoint = struct.Struct(b'<Qd')
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def _encode_runs(runs, length):
+    """Encode the (start, count) runs of log items of the given length
+    as varints.  Each run is stored as the gap since the end of the
+    previous run, shifted left by one, with the low bit set only if a
+    count greater than one follows."""
+    out = bytearray()
+    end = 0
+    for (start, count) in runs:
+        if count > 1:
+            _encode_varint(((start - end) << 1) | 1, out)
+            _encode_varint(count, out)
+        else:
+            _encode_varint((start - end) << 1, out)
+        end = start + count * length
+    return out
+
+
+def _decode_runs(data, pos, num_runs, length):
+    runs = []
+    end = 0
+    for _ in xrange(num_runs):
+        (value, pos) = _decode_varint(data, pos)
+        count = 1
+        if value & 1:
+            (count, pos) = _decode_varint(data, pos)
+        start = end + (value >> 1)
+        runs.append((start, count))
+        end = start + count * length
+    return runs
+
+
+class _Clock(object):
+    """Track the absolute time, in seconds since the epoch, through a
+    log from its DateTime and Timestamp items.  HighResTimer items
+    (milliseconds) advance the time from the last absolute value."""
+    def __init__(self):
+        self.time = None
+        self._hrt = None
+
+    def update(self, cfg):
+        if cfg.tag == LogItem_Time_DateTime.tag:
+            self.time = calendar.timegm((cfg.year, cfg.month, cfg.day, cfg.hours, cfg.minutes, cfg.seconds))
+            self._hrt = None
+        elif cfg.tag == LogItem_Time_Timestamp.tag:
+            self.time = cfg.timestamp
+            self._hrt = None
+        elif cfg.tag == LogItem_Time_HighResTimer.tag:
+            if self.time is not None and self._hrt is not None and cfg.hrt >= self._hrt:
+                self.time += (cfg.hrt - self._hrt) / 1000.0
+            self._hrt = cfg.hrt
+
+
+def build_index(filename, checkpoint_interval=65536):
+    """Build an index of a log file and write it alongside the file,
+    with INDEX_SUFFIX appended to the filename.  The index holds the
+    offsets of every log item by tag, stored as (start, count) runs of
+    consecutive items with the same tag and varint encoded relative to
+    the end of the previous run, plus time checkpoints, taken
+    at time items at most every checkpoint_interval bytes, which map a
+    file offset to an absolute time.  The index is also returned.
+    """
+    st = os.stat(filename)
+    runs = dict([(tag, []) for tag in _tag_lookup])
+    checkpoints = []
+    skipped = []
+    clock = _Clock()
+    if st.st_size:
+        with open(filename, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                (run_tag, run_start, run_end) = (None, 0, 0)
+                for (offset, tag) in _iter_offsets(mm, skipped):
+                    if tag != run_tag or offset != run_end:
+                        if run_tag is not None:
+                            runs[run_tag].append((run_start, (run_end - run_start) // _tag_lookup[run_tag][1]))
+                        (run_tag, run_start) = (tag, offset)
+                    run_end = offset + _tag_lookup[tag][1]
+                    if tag in _time_tags:
+                        clock.update(decode(mm, offset))
+                        if clock.time is not None and \
+                            (not checkpoints or (offset - checkpoints[-1][0]) >= checkpoint_interval):
+                            checkpoints.append((offset, clock.time))
+                if run_tag is not None:
+                    runs[run_tag].append((run_start, (run_end - run_start) // _tag_lookup[run_tag][1]))
+            finally:
+                mm.close()
+
+    index = { 'size': st.st_size, 'mtime': st.st_mtime,
+              'runs': runs, 'checkpoints': checkpoints }
+
+    with open(filename + INDEX_SUFFIX, 'wb') as fp:
+        fp.write(_index_header.pack(_INDEX_MAGIC, _INDEX_VERSION, st.st_size, st.st_mtime, len(runs)))
+        for tag in sorted(runs):
+            encoded = _encode_runs(runs[tag], _tag_lookup[tag][1])
+            fp.write(_index_tag_header.pack(tag, len(runs[tag]), len(encoded)))
+            fp.write(encoded)
+        fp.write(_index_count.pack(len(checkpoints)))
+        for checkpoint in checkpoints:
+            fp.write(_index_checkpoint.pack(*checkpoint))
+
+    return index
+
+
+def load_index(filename):
+    """Load the index of a log file written by build_index.  None is
+    returned if there is no index or if the log file has changed since
+    the index was built."""
+    try:
+        with open(filename + INDEX_SUFFIX, 'rb') as fp:
+            data = fp.read()
+        st = os.stat(filename)
+        (magic, version, size, mtime, num_tags) = _index_header.unpack_from(data, 0)
+    except (IOError, OSError, struct.error):
+        return None
+
+    if magic != _INDEX_MAGIC or version != _INDEX_VERSION or \
+        size != st.st_size or mtime != st.st_mtime:
+        return None
+
+    pos = _index_header.size
+    encoded = bytearray(data)
+    runs = {}
+    for _ in range(num_tags):
+        (tag, count, length) = _index_tag_header.unpack_from(data, pos)
+        pos += _index_tag_header.size
+        if tag in _tag_lookup:
+            runs[tag] = _decode_runs(encoded, pos, count, _tag_lookup[tag][1])
+        pos += length
+    (count,) = _index_count.unpack_from(data, pos)
+    pos += _index_count.size
+    checkpoints = []
+    for _ in range(count):
+        checkpoints.append(_index_checkpoint.unpack_from(data, pos))
+        pos += _index_checkpoint.size
+
+    return { 'size': size, 'mtime': mtime,
+             'runs': runs, 'checkpoints': checkpoints }
+
+
+def _iter_runs(runs, length, start, end):
+    """Generator which expands (start, count) runs of log items of the
+    given length to the item offsets between start and end"""
+    i = max(0, bisect.bisect_right(runs, (start,)) - 1)
+    while i < len(runs):
+        (run_start, count) = runs[i]
+        if run_start >= end:
+            return
+        if run_start < start:
+            run_start += ((start - run_start + length - 1) // length) * length
+            count -= (run_start - runs[i][0]) // length
+        for offset in xrange(run_start, min(end, run_start + count * length), length):
+            yield offset
+        i += 1
+
+
+def iter_query(filename, since=None, until=None, names=None, index=None):
+    """Generator which decodes only those log objects of a file that
+    have one of the given names and/or were logged between since and
+    until (seconds since the epoch).  The file's index, see
+    build_index, is used to seek straight to the matching log items so
+    the rest of the file is not decoded.  Time filtering assumes time
+    moves forwards through the log.
+    """
+    if index is None:
+        index = load_index(filename) or build_index(filename)
+    if not index['size']:
+        return
+
+    runs = index['runs']
+    checkpoints = index['checkpoints']
+    times = [t for (_, t) in checkpoints]
+    timed = since is not None or until is not None
+
+    # Narrow down the byte range of interest using the time checkpoints
+    clock = _Clock()
+    start = 0
+    end = index['size']
+    if since is not None:
+        i = bisect.bisect_right(times, since) - 1
+        if i >= 0:
+            (start, clock.time) = checkpoints[i]
+    if until is not None:
+        i = bisect.bisect_right(times, until)
+        if i < len(checkpoints):
+            end = checkpoints[i][0]
+
+    wanted = set([tag for tag in _tag_lookup if names is None or _tag_lookup[tag][0].name in names])
+    scan = wanted | _time_tags if timed else wanted
+    streams = [_iter_runs(runs.get(tag, []), _tag_lookup[tag][1], start, end) for tag in scan]
+
+    with open(filename, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in heapq.merge(*streams):
+                cfg = decode(mm, offset)
+                if cfg.tag in _time_tags:
+                    clock.update(cfg)
+                if cfg.tag not in wanted:
+                    continue
+                if timed and (clock.time is None or \
+                              (since is not None and clock.time < since) or \
+                              (until is not None and clock.time > until)):
+                    continue
+                yield cfg
+        finally:
+            mm.close()
+
+
+def _scan_offsets(data):
+    """Return an array of the offsets at which each log item of an input
+    data buffer starts, see _iter_chains"""
+    offsets = array('l')
+    for (start, _, _, positions) in _iter_chains(data):
+        offsets.extend([start + i for i in positions])
+    return offsets
+
+
+_numpy_type = {
+    'B': '<u1', 'b': '<i1', 'H': '<u2', 'h': '<i2',
+    'I': '<u4', 'i': '<i4', 'L': '<u4', 'l': '<i4',
+    'Q': '<u8', 'q': '<i8', 'f': '<f4', 'd': '<f8',
+}
+
+
+def _column_dtypes(cls):
+    """Return the (raw, scaled) numpy dtypes for a log item class.  The
+    raw dtype matches the packed record payload and the scaled dtype
+    is that of the returned columns, which are prefixed with the
+    record index."""
+    cfg = cls()
+    scaling = _column_scaling.get(cls, {})
+    args = iter(cfg._args[1:]) # Skip tag
+    raw = []
+    for (count, code) in re.findall(r'(\d*)([a-zA-Z])', cfg._fmt[2:]):
+        count = int(count) if count else 1
+        if code == 's':
+            raw.append((next(args), 'S%u' % count))
+        else:
+            raw += [(next(args), _numpy_type[code]) for _ in range(count)]
+    scaled = [('index', '<i8')] + [(k, '<f8' if k in scaling else t) for (k, t) in raw]
+    return (numpy.dtype(raw), numpy.dtype(scaled))
+
+
+def decode_columns(data, names=None):
+    """Decode an input data buffer to a dict of log item name -> numpy
+    structured array, with one array row per log item and one column
+    per field.  Fields are scaled in the same way as the per-object
+    decoders e.g., GPS latitude/longitude in degrees.  Each row also
+    carries the log item's index in the log so items of different
+    types can be put back in order.  The names argument optionally
+    restricts the output to a list of log item names.
+    """
+    if numpy is None:
+        raise ImportError('numpy is required for decode_columns')
+
+    offsets = _scan_offsets(data)
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    offsets = numpy.frombuffer(offsets, dtype=numpy.dtype('l')) if offsets else numpy.zeros(0, dtype=numpy.int64)
+    tags = raw[offsets]
+
+    columns = {}
+    for tag in sorted(_tag_lookup):
+        (cls, length) = _tag_lookup[tag]
+        if names is not None and cls.name not in names:
+            continue
+        index = numpy.nonzero(tags == tag)[0]
+        if not len(index) and names is None:
+            continue
+        (raw_dtype, dtype) = _column_dtypes(cls)
+        column = numpy.zeros(len(index), dtype=dtype)
+        column['index'] = index
+        if raw_dtype.itemsize and len(index):
+            # View the data as a packed record starting at every byte,
+            # after the tag, and take the rows at the item offsets so
+            # only the records themselves are copied
+            records = numpy.ndarray(shape=(len(raw) - length + 1,), dtype=raw_dtype,
+                                    buffer=raw, offset=1, strides=(1,))[offsets[index]]
+            scaling = _column_scaling.get(cls, {})
+            for k in raw_dtype.names:
+                if k in scaling:
+                    column[k] = records[k] * scaling[k]
+                else:
+                    column[k] = records[k]
+        columns[cls.name] = column
+
+    return columns
+
+
 def encode_all(objects):
     """Encode a list of log objects, in order, to a serial byte
     stream.
@@ -66,6 +663,19 @@ def encode_all(objects):
     return data
 
 
+_struct_cache = {}
+
+
+def _get_struct(fmt):
+    """Return a compiled struct object for the given format, compiling
+    it on first use only."""
+    packer = _struct_cache.get(fmt)
+    if packer is None:
+        packer = struct.Struct(fmt)
+        _struct_cache[fmt] = packer
+    return packer
+
+
 class _Blob(object):
     """Blob object is a container for arbitrary message fields which
     can be packed / unpacked using python struct"""
@@ -81,13 +691,13 @@ class _Blob(object):
         self._args += args
 
     def pack(self):
-        packer = struct.Struct(self._fmt)
+        packer = _get_struct(self._fmt)
         args = tuple([getattr(self, k) for k in self._args])
         return packer.pack(*args)
 
-    def unpack(self, data):
-        unpacker = struct.Struct(self._fmt)
-        unpacked = unpacker.unpack_from(data)
+    def unpack(self, data, offset=0):
+        unpacker = _get_struct(self._fmt)
+        unpacked = unpacker.unpack_from(data, offset)
         i = 0
         for k in self._args:
             setattr(self, k, unpacked[i])
@@ -116,6 +726,21 @@ class LogItem(TaggedItem):
         for k in kwargs.keys():
             setattr(self, k, kwargs[k])
 
+    def __reduce__(self):
+        # Pickle as the tag plus decoded field values only, which keeps
+        # the transfer of log objects between processes compact
+        return (_rebuild, (self.tag, tuple([getattr(self, k) for k in self._args[1:]])))
+
+
+def _rebuild(tag, values):
+    """Rebuild a pickled log object without going through its
+    constructor"""
+    (cls, template) = _rebuild_lookup[tag]
+    cfg = cls.__new__(cls)
+    cfg.__dict__.update(template)
+    cfg.__dict__.update(zip(template['_args'][1:], values))
+    return cfg
+
 
 class LogItem_Builtin_LogStart(LogItem):
     tag = 0x7E
@@ -158,8 +783,8 @@ class LogItem_GPS_Position(LogItem):
         self.accuracyVertical = accuracyVertical
         return data
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         self.longitude = 1E-7 * self.longitude
         self.latitude = 1E-7 * self.latitude
         self.height = self.height / 1000.0
@@ -191,8 +816,8 @@ class LogItem_Pressure_Pressure(LogItem):
         self.pressure = pressure
         return data
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         self.pressure = self.pressure / 1000.0
 
 class LogItem_AXL_XYZ(LogItem):
@@ -290,8 +915,8 @@ class LogItem_Bluetooth_Enabled(LogItem):
         self.cause = cause
         return data
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         if (self.cause == 0):
             self.cause = 'REED_SWITCH'
         elif (self.cause == 1):
@@ -326,8 +951,8 @@ class LogItem_Bluetooth_Disabled(LogItem):
         self.cause = cause
         return data
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         if (self.cause == 0):
             self.cause = 'REED_SWITCH'
         elif (self.cause == 1):
@@ -369,8 +994,8 @@ class LogItem_SoftWatchdog(LogItem):
     def __init__(self, **kwargs):
         LogItem.__init__(self, b'I', self.fields, **kwargs)
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         self.watchdogAddress = hex(self.watchdogAddress)
 
 
@@ -383,8 +1008,8 @@ class LogItem_Startup(LogItem):
     def __init__(self, **kwargs):
         LogItem.__init__(self, b'I', self.fields, **kwargs)
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         self.cause = hex(self.cause)
 
 
@@ -411,8 +1036,8 @@ class LogItem_IOT_Status(LogItem):
         self.status = status
         return data
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         try:
             self.status = self.allowed_status[self.status]
         except:
@@ -453,8 +1078,8 @@ class LogItem_IOT_networkInfo(LogItem):
     def __init__(self, **kwargs):
         LogItem.__init__(self, b'BBB25s5s9s', self.fields, **kwargs)
 
-    def unpack(self, data):
-        LogItem.unpack(self, data)
+    def unpack(self, data, offset=0):
+        LogItem.unpack(self, data, offset)
         self.network_operator = self.network_operator.split('\0')[0]
         self.location_area_code = self.location_area_code.split('\0')[0]
         self.cell_id = self.cell_id.split('\0')[0]
@@ -471,4 +1096,51 @@ class LogItem_IOT_Next_prepas(LogItem):
     fields = [ 'next_satellite_predict', 'gps_timestamp']
 
     def __init__(self, **kwargs):
-        LogItem.__init__(self, b'II', self.fields, **kwargs)
\ No newline at end of file
+        LogItem.__init__(self, b'II', self.fields, **kwargs)
+
+
+def _build_tag_lookup():
+    """Build a lookup table of tag -> (class, length) for all log item
+    classes defined in this module"""
+    lookup = {}
+    for i in inspect.getmembers(sys.modules[__name__], inspect.isclass):
+        cls = i[1]
+        if issubclass(cls, LogItem) and cls != LogItem:
+            lookup[cls.tag] = (cls, cls().length)
+    return lookup
+
+
+_tag_struct = struct.Struct(b'<B')
+_tag_lookup = _build_tag_lookup()
+_time_tags = set([LogItem_Time_DateTime.tag, LogItem_Time_Timestamp.tag, LogItem_Time_HighResTimer.tag])
+_rebuild_lookup = dict([(tag, (cls, cls().__dict__)) for (tag, (cls, _)) in _tag_lookup.items()])
+
+
+# Scale factors applied by decode_columns, matching LogItem.unpack
+_column_scaling = {
+    LogItem_GPS_Position: {
+        'longitude': 1E-7,
+        'latitude': 1E-7,
+        'height': 1E-3,
+        'accuracyHorizontal': 1E-3,
+        'accuracyVertical': 1E-3,
+    },
+    LogItem_Pressure_Pressure: {
+        'pressure': 1E-3,
+    },
+}
+
+
+def _build_candidate_re():
+    """Build a regular expression, over data translated to item lengths,
+    matching a known tag followed by another known tag"""
+    lengths = sorted(set([_tag_lookup[tag][1] for tag in _tag_lookup]))
+    alternatives = [re.escape(chr(length)) + '.' * (length - 1) + '[^\\x00]' for length in lengths]
+    return re.compile('|'.join(alternatives), re.DOTALL)
+
+
+# Lookup tables used to resynchronise decoding after corrupt data
+_length_table = ''.join([chr(_tag_lookup[tag][1]) if tag in _tag_lookup else '\x00' for tag in range(256)])
+_max_length = max([_tag_lookup[tag][1] for tag in _tag_lookup])
+_marker_tags = (chr(LogItem_Builtin_LogStart.tag), chr(LogItem_Builtin_LogEnd.tag))
+_candidate_re = _build_candidate_re()
@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def status_device_id(status):
+    """Return the log store key of a device given its status, as
+    returned by ConfigInterface.get_status, where the unique device
+    identifier is already a hex string"""
+    return status['unique_device_identifier'].upper()
+
+
+class LogStore(object):
+    """A local store of log files downloaded from devices, holding one
+    log file per device.  Each sync only downloads the part of the
+    device's log file which is not already held in the store."""
+
+    # Number of bytes already held which are downloaded again on each
+    # sync to check that the device's log file has only been appended to
+    overlap = 64
+
+    def __init__(self, path):
+        self._path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, device_id):
+        return os.path.join(self._path, '%s.bin' % device_id)
+
+    def size(self, device_id):
+        """Return the number of log file bytes held for a device"""
+        filename = self.filename(device_id)
+        return os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def _rotate(self, filename):
+        """Move an existing log file aside so a fresh copy can be
+        downloaded"""
+        rotated = '%s.%s' % (filename, time.strftime('%Y%m%d_%H%M%S'))
+        suffix = 1
+        while os.path.exists(rotated):
+            rotated = '%s.%s_%u' % (filename, time.strftime('%Y%m%d_%H%M%S'), suffix)
+            suffix = suffix + 1
+        logger.warn('Device log file no longer matches %s - moving it to %s', filename, rotated)
+        os.rename(filename, rotated)
+
+    def _read(self, filename, start, length):
+        with open(filename, 'rb') as fp:
+            fp.seek(start)
+            return fp.read(length)
+
+    def sync(self, cfg, device_id=None, progress=None):
+        """Download any new log data from a device using the supplied
+        ConfigInterface, appending it to the device's log file in the
+        store as it arrives.  An interrupted sync therefore resumes from
+        where it stopped.  The device is identified by its unique device
+        identifier unless device_id is given.  See
+        ConfigInterface.download_log_file for progress.  Returns a tuple
+        of the store filename and the offset in that file at which the
+        new data starts, so the new log items can be decoded with
+        log.iter_decode from there.
+        """
+        if device_id is None:
+            device_id = status_device_id(cfg.get_status())
+        filename = self.filename(device_id)
+        local_size = self.size(device_id)
+        device_size = cfg.get_log_file_size()
+
+        if device_size < local_size:
+            self._rotate(filename)
+            local_size = 0
+
+        # The device log file must still start with what we already hold,
+        # otherwise it has been erased or has wrapped and we start again
+        overlap = min(self.overlap, local_size)
+        if overlap:
+            start = local_size - overlap
+            data = cfg.read_log_file(start, overlap)
+            if bytearray(self._read(filename, start, overlap)) != bytearray(data):
+                self._rotate(filename)
+                local_size = 0
+
+        logger.info('Log file for device %s: %u bytes held, %u bytes new', device_id,
+                    local_size, device_size - local_size)
+        with open(filename, 'ab') as fp:
+            cfg.download_log_file(fp, local_size, device_size - local_size, progress)
+
+        return (filename, local_size)
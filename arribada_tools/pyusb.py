@@ -1,5 +1,6 @@
 import os
 import threading
+import Queue
 import usb
 import logging
 import sys
@@ -16,84 +17,109 @@ class UsbOverlappedResult(threading._Event):
 
 class UsbOverlappedEndpoint(threading.Thread):
 
+    # Bulk transfer size used when reading straight to a file
+    file_transfer_size = 65536
+    # Number of bulk IN buffers which may be read ahead of the file writer
+    file_buffers = 3
+
     def __init__(self, ep):
         self._ep = ep
-        self._is_stopping = False
-        self._queue = []
-        self._event = threading.Event()
+        self._queue = Queue.Queue()
         threading.Thread.__init__(self)
         self.start()
 
     def run(self):
         if (self._ep.bEndpointAddress & 0x80):
-            self._read_handler()
+            handler = self._read_handler
         else:
-            self._write_handler()
-
-    def _read_handler(self):
-        while (not self._is_stopping):
-            self._event.wait()
-            self._event.clear()
-            while (self._queue):
-                (result, length, timeout, fp) = self._queue.pop(0)
-                if fp is not None:
-                    curr_length = 0
-                    while curr_length < length and not result.cancel:
-                        try:
-                            b = self._ep.read(32768, timeout)
-                            if b:
-                                curr_length = curr_length + len(b)
-                                fp.write(b)
-                        except:
-                            logger.error("Unexpected error: %s", sys.exc_info()[0])
-                            break
-                    result.status = curr_length
-                else:
-                    try:
-                        result.buffer = self._ep.read(length, timeout) or b''
-                        result.status = len(result.buffer)
-                    except:
-                        logger.error("Unexpected error: %s", sys.exc_info()[0])
-                        result.status = -1
-                result.set()
-
-    def _write_handler(self):
-        while (not self._is_stopping):
-            self._event.wait()
-            self._event.clear()
-            while (self._queue):
-                (result, buf, timeout) = self._queue.pop(0)
+            handler = self._write_handler
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            result = request[0]
+            if result.cancel:
+                result.status = -1
+            else:
+                handler(*request)
+            result.set()
+
+    def _read_handler(self, result, length, timeout, fp):
+        if fp is not None:
+            result.status = self._read_to_file_handler(result, length, timeout, fp)
+            return
+        try:
+            result.buffer = self._ep.read(length, timeout) or b''
+            result.status = len(result.buffer)
+        except:
+            logger.error("Unexpected error: %s", sys.exc_info()[0])
+            result.status = -1
+
+    def _read_to_file_handler(self, result, length, timeout, fp):
+        """Keep bulk IN transfers running back to back while a writer
+        thread drains up to file_buffers received buffers to the file.
+        Returns the number of bytes written."""
+        buffers = Queue.Queue(self.file_buffers)
+        written = [0]
+        failed = threading.Event()
+
+        def writer():
+            while True:
+                b = buffers.get()
+                if b is None:
+                    break
+                if failed.is_set():
+                    continue
                 try:
-                    result.status = self._ep.write(buf, timeout)
+                    fp.write(b)
+                    written[0] = written[0] + len(b)
                 except:
                     logger.error("Unexpected error: %s", sys.exc_info()[0])
-                    result.status = -1
-                result.set()
+                    failed.set()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        curr_length = 0
+        while curr_length < length and not result.cancel and not failed.is_set():
+            try:
+                b = self._ep.read(min(self.file_transfer_size, length - curr_length), timeout)
+            except:
+                logger.error("Unexpected error: %s", sys.exc_info()[0])
+                break
+            if b:
+                curr_length = curr_length + len(b)
+                buffers.put(b)
+        buffers.put(None)
+        thread.join()
+        return written[0]
+
+    def _write_handler(self, result, buf, timeout):
+        try:
+            result.status = self._ep.write(buf, timeout)
+        except:
+            logger.error("Unexpected error: %s", sys.exc_info()[0])
+            result.status = -1
 
     def read(self, length, timeout=None):
         result = UsbOverlappedResult()
         result.clear()
-        self._queue += [(result, length, timeout, None)]
-        self._event.set()
+        self._queue.put((result, length, timeout, None))
         return result
 
     def read_to_file(self, length, fp, timeout=None):
         result = UsbOverlappedResult()
         result.clear()
-        self._queue += [(result, length, timeout, fp)]
-        self._event.set()
+        self._queue.put((result, length, timeout, fp))
         return result
     
     def write(self, data, timeout=None):
         result = UsbOverlappedResult()
         result.clear()
-        self._queue += [(result, data, timeout)]
-        self._event.set()
+        self._queue.put((result, data, timeout))
         return result
 
     def stop(self):
-        self._is_stopping = True
-        self._event.set()
+        self._queue.put(None)
         self.join()
 
 
@@ -1,8 +1,15 @@
 import struct
 import binascii
+import operator
 from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _UBX_MIN_MESSAGE_LEN = 8
+_header = struct.Struct('<ccBBH')
+_checksum_struct = struct.Struct('<BB')
 
 
 class _Sync(object):
@@ -196,31 +203,107 @@ _class_dict = {
     0x27: _sec_dict,
 }
 
-def _key_lookup(d, value):
-    for key in d:
-        if d[key] == value:
-            return key
-
-
-def _class_lookup(cls):
-    for key in _class_dict:
-        if _class_dict[key]['class'] == cls:
-            return key
+# Reverse lookup tables between message names e.g., 'MGA-FLASH' and
+# (cls, msg_id) tuples, built once from the tables above
+_id_to_string = {}
+_string_to_id = {}
+for (_cls, _d) in _class_dict.items():
+    for (_msg_id, _name) in _d.items():
+        if _msg_id != 'class':
+            _id_to_string[(_cls, _msg_id)] = _d['class'] + '-' + _name
+            _string_to_id[_d['class'] + '-' + _name] = (_cls, _msg_id)
+del _cls, _d, _msg_id, _name
+
+# (cls, msg_id) of the messages built or matched by this package
+ACK_ACK = (0x05, 0x01)
+ACK_NAK = (0x05, 0x00)
+CFG_CFG = (0x06, 0x09)
+CFG_INF = (0x06, 0x02)
+CFG_MSG = (0x06, 0x01)
+CFG_PRT = (0x06, 0x00)
+CFG_RINV = (0x06, 0x34)
+CFG_TP5 = (0x06, 0x31)
+MGA_FLASH = (0x13, 0x21)
+MON_HW = (0x0A, 0x09)
+MON_HW2 = (0x0A, 0x0B)
+MON_VER = (0x0A, 0x04)
+NAV_CLOCK = (0x01, 0x22)
+NAV_DOP = (0x01, 0x04)
+NAV_POSLLH = (0x01, 0x02)
+NAV_PVT = (0x01, 0x07)
+NAV_SAT = (0x01, 0x35)
+NAV_SOL = (0x01, 0x06)
+NAV_STATUS = (0x01, 0x03)
+NAV_SVINFO = (0x01, 0x30)
+NAV_TIMEUTC = (0x01, 0x21)
+NAV_VELNED = (0x01, 0x12)
+RXM_RAWX = (0x02, 0x15)
+RXM_SFRBX = (0x02, 0x13)
+RXM_SVSI = (0x02, 0x20)
 
 
 def _checksum(class_and_payload):
-    ck_a = 0
-    ck_b = 0
-    for i in class_and_payload:
-        ck_a = ck_a + struct.unpack('B', i)[0]
-        ck_b = ck_b + ck_a
-    ck = struct.pack('<BB', ck_a & 0xFF, ck_b & 0xFF)
-    return ck
+    # The 8-bit Fletcher sums are CK_A = sum(b[i]) and
+    # CK_B = sum((n - i) * b[i]) = n * CK_A - sum(i * b[i])
+    data = bytearray(class_and_payload)
+    ck_a = sum(data)
+    ck_b = len(data) * ck_a - sum(map(operator.mul, xrange(len(data)), data))
+    return _checksum_struct.pack(ck_a & 0xFF, ck_b & 0xFF)
+
+
+def _checksums(data, spans):
+    """Return the checksums of the [start, end) spans of data as a list
+    of (CK_A, CK_B) tuples.  With numpy, all spans are summed at once
+    from the first and second cumulative sums of data."""
+    if numpy is None or not spans:
+        return [_checksum_struct.unpack(_checksum(buffer(data, start, end - start)))
+                for (start, end) in spans]
+    s1 = numpy.zeros(len(data) + 1, numpy.int64)
+    numpy.cumsum(numpy.frombuffer(buffer(data), numpy.uint8), out=s1[1:])
+    s2 = numpy.cumsum(s1)
+    spans = numpy.array(spans, numpy.int64)
+    (start, end) = (spans[:, 0], spans[:, 1])
+    # sum over k in [start, end) of (s1[k + 1] - s1[start])
+    ck_a = s1[end] - s1[start]
+    ck_b = s2[end] - s2[start] - (end - start) * s1[start]
+    return zip((ck_a & 0xFF).tolist(), (ck_b & 0xFF).tolist())
+
+
+def ubx_scan(data):
+    """Return the (start, end) offsets of every valid UBX message in
+    data.  Message boundaries are found first and then all checksums are
+    verified at once, only rescanning from any corrupt message."""
+    data = data.tostring() if type(data) == array else data
+    sync = _Sync.SYNC1 + _Sync.SYNC2
+    valid = []
+    pos = 0
+    while True:
+        spans = []
+        start = data.find(sync, pos)
+        while start >= 0 and len(data) - start >= _UBX_MIN_MESSAGE_LEN:
+            [length] = struct.unpack_from('<H', data, start + 4)
+            end = start + _UBX_MIN_MESSAGE_LEN + length
+            if end > len(data):
+                # Truncated, or SYNC bytes within another message's payload
+                start = data.find(sync, start + 2)
+                continue
+            spans.append((start, end))
+            start = data.find(sync, end)
+        checksums = _checksums(data, [(i + 2, j - 2) for (i, j) in spans])
+        for ((start, end), ck) in zip(spans, checksums):
+            if _checksum_struct.unpack_from(data, end - 2) != ck:
+                pos = start + 2
+                break
+            valid.append((start, end))
+        else:
+            return valid
 
 
 def ubx_extract(data):
     if type(data) == array:
         data = "".join(map(chr, data))
+    elif type(data) == bytearray:
+        data = str(data)
     try:
         pos = data.index(_Sync.SYNC1)
     except:
@@ -238,57 +321,137 @@ def ubx_extract(data):
     if ck[0] != data[pos+6+length] or \
         ck[1] != data[pos+7+length]:
         print 'Failed'
-        return (b'', data[pos:])
+        return (b'', data[pos+2:]) # Resynchronise after the corrupt message's SYNC bytes
     else:
         return (data[pos:pos+_UBX_MIN_MESSAGE_LEN+length], data[pos+_UBX_MIN_MESSAGE_LEN+length:])
 
 
+class UbxStreamParser(object):
+    """Incremental UBX parser.  Received data is fed in as it arrives
+    and complete messages are parsed from a cursor into one buffer, which
+    is only compacted once the consumed data passes compact_size.
+    Messages are returned as memoryviews into the buffer, so are not
+    copied; a memoryview remains valid after further data is fed."""
+
+    compact_size = 65536
+    max_length = 8192 # Longer lengths are treated as corruption
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def feed(self, data):
+        if type(data) == array:
+            data = data.tostring()
+        try:
+            if self._pos >= self.compact_size:
+                del self._buffer[:self._pos]
+                self._pos = 0
+            self._buffer += data
+        except BufferError:
+            # Messages still reference the buffer so continue in a new one
+            self._buffer = self._buffer[self._pos:] + data
+            self._pos = 0
+
+    def pending(self):
+        """Number of bytes fed but not yet parsed"""
+        return len(self._buffer) - self._pos
+
+    def _next(self):
+        """Return the (start, end) offsets of the next valid message in
+        the buffer and advance past it, or None if no complete message
+        has been received"""
+        buf = self._buffer
+        while True:
+            start = buf.find(_Sync.SYNC1 + _Sync.SYNC2, self._pos)
+            if start < 0:
+                # Keep a trailing SYNC1 which may start the next message
+                self._pos = len(buf) - 1 if buf[-1:] == _Sync.SYNC1 else len(buf)
+                return None
+            self._pos = start
+            if len(buf) - start < _UBX_MIN_MESSAGE_LEN:
+                return None
+            [length] = struct.unpack_from('<H', buf, start + 4)
+            end = start + _UBX_MIN_MESSAGE_LEN + length
+            if length > self.max_length:
+                self._pos = start + 2
+                continue
+            if end > len(buf):
+                return None
+            self._pos = start + 2
+            if _checksum(buf[start+2:end-2]) == buf[end-2:end]:
+                self._pos = end
+                return (start, end)
+
+    def messages(self):
+        """Yield each complete message received, including its SYNC
+        bytes and checksum"""
+        while True:
+            span = self._next()
+            if not span:
+                return
+            yield memoryview(self._buffer)[span[0]:span[1]]
+
+    def frames(self):
+        """Yield (cls, msg_id, payload) for each complete message
+        received"""
+        while True:
+            span = self._next()
+            if not span:
+                return
+            (cls, msg_id) = struct.unpack_from('BB', self._buffer, span[0] + 2)
+            yield (cls, msg_id, memoryview(self._buffer)[span[0]+6:span[1]-2])
+
+
 def ubx_build(cls, msg_id, payload):
-    hdr = struct.pack('<BBH', cls, msg_id, len(payload))
-    msg = _Sync.SYNC1 + _Sync.SYNC2 + hdr + payload
-    return msg + _checksum(msg[2:])
+    length = len(payload)
+    msg = bytearray(length + _UBX_MIN_MESSAGE_LEN)
+    _header.pack_into(msg, 0, _Sync.SYNC1, _Sync.SYNC2, cls, msg_id, length)
+    msg[6:6+length] = payload
+    msg[6+length:] = _checksum(buffer(msg, 2, 4 + length))
+    return str(msg)
 
 
 def ubx_to_string(msg):
-    (cls, msg_id) = struct.unpack('BB', msg[2:4])
+    (cls, msg_id) = struct.unpack_from('BB', msg, 2)
+    return ubx_id_to_string(cls, msg_id)
+
+
+def ubx_id_to_string(cls, msg_id):
+    text = _id_to_string.get((cls, msg_id))
+    if text:
+        return text
     if cls in _class_dict:
-        text = _class_dict[cls]['class']
-        if msg_id in _class_dict[cls]:
-            text = text + '-' + _class_dict[cls][msg_id]
-        else:
-            text = text + '-???(%02x)' % msg_id
+        text = _class_dict[cls]['class'] + '-???(%02x)' % msg_id
     else:
         text = '???(%02x)-???(%02x)' % (cls, msg_id)
     return text
 
 
 def ubx_string_to_cls_msg_id(s):
-    (cls, msg_id) = s.split('-')
-    cls = _class_lookup(cls)
-    msg_id = _key_lookup(_class_dict[cls], msg_id)
-    return (cls, msg_id)
+    return _string_to_id[s]
 
 
 def ubx_mga_flash_data(sequence, mga_ano_payload):
-    (cls, msg_id) = ubx_string_to_cls_msg_id('MGA-FLASH')
+    (cls, msg_id) = MGA_FLASH
     payload = struct.pack('<BBHH', 0x01, 0x00, sequence, len(mga_ano_payload))
     return ubx_build(cls, msg_id, payload + mga_ano_payload)
 
 
 def ubx_mga_flash_stop():
-    (cls, msg_id) = ubx_string_to_cls_msg_id('MGA-FLASH')
+    (cls, msg_id) = MGA_FLASH
     payload = struct.pack('<BB', 0x02, 0x00)
     return ubx_build(cls, msg_id, payload)
 
 
 def ubx_cfg_save_flash():
-    (cls, msg_id) = ubx_string_to_cls_msg_id('CFG-CFG')
+    (cls, msg_id) = CFG_CFG
     payload = struct.pack('<IIIB', 0, 0xFFFFFFFF, 0, 0x2)
     return ubx_build(cls, msg_id, payload)
 
 
 def ubx_cfg_uart(baudrate):
-    (cls, msg_id) = ubx_string_to_cls_msg_id('CFG-PRT')
+    (cls, msg_id) = CFG_PRT
     payload = struct.pack('<BxH2I3H2x',
                           1, 0, (3 << 6) | (4 << 9),
                           baudrate,
@@ -296,11 +459,119 @@ def ubx_cfg_uart(baudrate):
     return ubx_build(cls, msg_id, payload)
 
 
+# Number of leading payload bytes selecting which instance of a CFG
+# message is set or polled e.g., the port of CFG-PRT
+_cfg_key_length = {
+    CFG_INF: 1,
+    CFG_MSG: 2,
+    CFG_PRT: 1,
+    CFG_TP5: 1,
+}
+
+
+def ubx_cfg_key(cls, msg_id, payload):
+    """Return a (cls, msg_id, selector) key identifying the configuration
+    which a CFG payload sets or, in a poll response, reports.  Building
+    a message from the key gives the request to poll it."""
+    return (cls, msg_id, memoryview(payload)[:_cfg_key_length.get((cls, msg_id), 0)].tobytes())
+
 def ubx_mga_flash_ack_extract(msg):
-    (_, _, ack, _, sequence) = struct.unpack('<BBBBH', msg[6:12])
+    return ubx_mga_flash_ack_payload_extract(memoryview(msg)[6:])
+
+
+def ubx_mga_flash_ack_payload_extract(payload):
+    (_, _, ack, _, sequence) = struct.unpack_from('<BBBBH', payload)
     return (ack, sequence)
 
 
+class _PayloadDecoder(object):
+    """Decoder of a UBX payload to a dictionary of named fields.  Any
+    repeated blocks following the fixed part are decoded to a list of
+    dictionaries, with the number of blocks given by the count field or
+    otherwise by the payload length."""
+
+    def __init__(self, fmt, fields, block_name=None, block_fmt=None, block_fields=None, count=None):
+        self._struct = struct.Struct(fmt)
+        self._fields = fields.split()
+        self._block_name = block_name
+        self._block_struct = struct.Struct(block_fmt) if block_fmt else None
+        self._block_fields = block_fields.split() if block_fields else None
+        self._count = count
+        self._strings = 's' in fmt or 's' in (block_fmt or '')
+
+    def decode(self, payload):
+        if len(payload) < self._struct.size:
+            return None
+        values = dict(zip(self._fields, self._struct.unpack_from(payload)))
+        if self._block_struct:
+            size = self._block_struct.size
+            if self._count:
+                count = values[self._count]
+            else:
+                count = (len(payload) - self._struct.size) // size
+            if len(payload) < self._struct.size + count * size:
+                return None
+            values[self._block_name] = [dict(zip(self._block_fields,
+                                                 self._block_struct.unpack_from(payload, self._struct.size + i * size)))
+                                        for i in xrange(count)]
+        if self._strings:
+            _strip_strings(values)
+        return values
+
+
+def _strip_strings(values):
+    for (key, value) in values.items():
+        if isinstance(value, str):
+            values[key] = value.rstrip('\0')
+        elif isinstance(value, list):
+            for i in value:
+                _strip_strings(i)
+
+
+# Payload decoders for the periodic and polled NAV, MON and RXM output
+# of the u-blox M8 receiver, by (cls, msg_id)
+_decoder_dict = {
+    NAV_CLOCK: _PayloadDecoder('<IiiII', 'iTOW clkB clkD tAcc fAcc'),
+    NAV_DOP: _PayloadDecoder('<I7H', 'iTOW gDOP pDOP tDOP vDOP hDOP nDOP eDOP'),
+    NAV_POSLLH: _PayloadDecoder('<IiiiiII', 'iTOW lon lat height hMSL hAcc vAcc'),
+    NAV_PVT: _PayloadDecoder('<IHBBBBBBIiBBBBiiiiIIiiiiiIIH6xihH',
+                             'iTOW year month day hour min sec valid tAcc nano fixType flags flags2 numSV '
+                             'lon lat height hMSL hAcc vAcc velN velE velD gSpeed headMot sAcc headAcc '
+                             'pDOP headVeh magDec magAcc'),
+    NAV_SAT: _PayloadDecoder('<IBB2x', 'iTOW version numSvs',
+                             'svs', '<BBBbhhI', 'gnssId svId cno elev azim prRes flags', 'numSvs'),
+    NAV_SOL: _PayloadDecoder('<IihBBiiiIiiiIHxB4x',
+                             'iTOW fTOW week gpsFix flags ecefX ecefY ecefZ pAcc ecefVX ecefVY ecefVZ sAcc '
+                             'pDOP numSV'),
+    NAV_STATUS: _PayloadDecoder('<IBBBBII', 'iTOW gpsFix flags fixStat flags2 ttff msss'),
+    NAV_SVINFO: _PayloadDecoder('<IBB2x', 'iTOW numCh globalFlags',
+                                'svs', '<BBBBBbhi', 'chn svid flags quality cno elev azim prRes', 'numCh'),
+    NAV_TIMEUTC: _PayloadDecoder('<IIiHBBBBBB', 'iTOW tAcc nano year month day hour min sec valid'),
+    NAV_VELNED: _PayloadDecoder('<IiiiIIiII', 'iTOW velN velE velD speed gSpeed heading sAcc cAcc'),
+    MON_HW: _PayloadDecoder('<IIIIHHBBBxI17xB2xIII',
+                            'pinSel pinBank pinDir pinVal noisePerMS agcCnt aStatus aPower flags usedMask '
+                            'jamInd pinIrq pullH pullL'),
+    MON_HW2: _PayloadDecoder('<bBbBB3xI8xI4x', 'ofsI magI ofsQ magQ cfgSource lowLevCfg postStatus'),
+    MON_VER: _PayloadDecoder('<30s10s', 'swVersion hwVersion', 'extensions', '<30s', 'extension'),
+    RXM_RAWX: _PayloadDecoder('<dHbBB3x', 'rcvTow week leapS numMeas recStat',
+                              'meas', '<ddfBBxBHBBBBBx',
+                              'prMes cpMes doMes gnssId svId freqId locktime cno prStdev cpStdev doStdev trkStat',
+                              'numMeas'),
+    RXM_SFRBX: _PayloadDecoder('<BBxBBxBx', 'gnssId svId freqId numWords version',
+                               'words', '<I', 'dwrd', 'numWords'),
+    RXM_SVSI: _PayloadDecoder('<IhBB', 'iTOW week numVis numSV',
+                              'svs', '<BBhbB', 'svid svFlag azim elev age', 'numSV'),
+}
+
+
+def ubx_decode(cls, msg_id, payload):
+    """Decode a UBX payload to a dictionary of its fields, or return
+    None if the message type has no decoder or the payload is short"""
+    decoder = _decoder_dict.get((cls, msg_id))
+    if decoder:
+        return decoder.decode(payload)
+
+
 
 
 # Convert ASCII configuration message as retrieved using u-center
@@ -315,12 +586,21 @@ def ubx_mga_flash_ack_extract(msg):
 # bytes and then appending the CK_A and CK_B checksum bytes.
 
 def ubx_build_from_ascii_cfg(text):
-    msg = text.split(' ')
-    if 'CFG' not in msg[0]: return b''
-    data = _Sync.SYNC1 + _Sync.SYNC2 + ''.join([struct.pack('B', int(i, 16)) for i in msg[2:]])
-    return data + _checksum(data[2:])
+    msg = text.split()
+    if not msg or 'CFG' not in msg[0]: return b''
+    return _build_from_bytes(binascii.unhexlify(''.join(i.zfill(2) for i in msg[2:])))
 
 
 def ubx_build_from_ascii(text):
-    data = _Sync.SYNC1 + _Sync.SYNC2 + binascii.unhexlify(text)
-    return data + _checksum(data[2:])
+    return _build_from_bytes(binascii.unhexlify(text))
+
+
+def _build_from_bytes(class_and_payload):
+    """Frame class, id, length and payload bytes with SYNC bytes and a
+    checksum in one preallocated buffer"""
+    length = len(class_and_payload)
+    msg = bytearray(length + 4)
+    msg[0:2] = _Sync.SYNC1 + _Sync.SYNC2
+    msg[2:2+length] = class_and_payload
+    msg[2+length:] = _checksum(class_and_payload)
+    return str(msg)